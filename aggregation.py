@@ -0,0 +1,308 @@
+import numpy as np
+import pandas as pd
+
+
+# Aggregator functions whose value for a card without any transactions is 0
+# rather than nan (this is what pandas gives us for an all-nan group, too).
+zero_for_missing_aggregators = ['sum', 'nunique', 'count', 'size']
+
+# Of those, the ones that count things, so their values stay integers.
+counting_aggregators = ['nunique', 'count', 'size']
+
+
+def get_top_category(row):
+    '''Given a row with some categorical column, return the most commonly
+    occurring value (or NaN if none) for that card id and category.
+
+    This calls `mode()` once per card, which is way too slow for the whole
+    transactions tables, so `aggregate_card_features` uses `top_value_codes`
+    instead, which gives the same result for all cards at once.'''
+    mode = row.mode()
+    return mode.iat[0] if len(mode) > 0 else np.nan
+
+
+def value_codes(values):
+    '''Returns a pair of integer codes for the given series of values (-1 for
+    nan) and the values those codes stand for.
+
+    The codes are in the natural sort order of the values, which is the order
+    that `Series.mode` sorts its results in for the plain (csv) values. This
+    goes for categorical values as well, whatever the order of their categories
+    is (e.g. 'Y', 'N', 'Both' in `loaders.cat_triple`), so that ties between them
+    are broken the same way as for the plain values.
+    '''
+    if values.dtype.name == 'category':
+        codes, categories = values.cat.codes.values, values.cat.categories
+        if categories.is_monotonic_increasing:
+            return codes, categories
+        order = categories.argsort()
+        ranks = np.empty(len(order), dtype=np.int64)
+        ranks[order] = np.arange(len(order))
+        return np.where(codes >= 0, ranks[codes], -1), categories[order]
+    return pd.factorize(values, sort=True)
+
+
+def top_value_codes(group_codes, codes, n_groups, n_values):
+    '''Given arrays of group codes (in `[0, n_groups)`) and value codes (in
+    `[0, n_values)`, or -1 for nan), returns an array with the code of the most
+    commonly occurring value for each group, or -1 for groups without any
+    (non-nan) values.
+
+    Ties are broken in favour of the smallest value code, which (with the codes
+    from `value_codes`) makes this give the same result as `mode().iat[0]`.
+
+    Instead of calling `mode()` for every group we count the occurrences of all
+    (group, value) pairs with one sort, and then pick the first pair of each
+    group after ordering them by count.
+    '''
+    has_value = codes >= 0
+    keys = group_codes[has_value].astype(np.int64) * n_values + codes[has_value]
+    keys, counts = np.unique(keys, return_counts=True)
+    groups = keys // n_values
+
+    # `np.unique` returns the keys sorted by group and then value, and lexsort
+    # is stable, so for equal counts the smallest value comes first.
+    order = np.lexsort((-counts, groups))
+    groups, keys = groups[order], keys[order]
+    first_of_group = np.ones(len(groups), dtype=bool)
+    first_of_group[1:] = groups[1:] != groups[:-1]
+
+    top = np.full(n_groups, -1, dtype=np.int64)
+    top[groups[first_of_group]] = keys[first_of_group] % n_values
+    return top
+
+
+def group_transactions_by_card(cards_index, trans_df, column_names):
+    '''Factorizes the `card_id` column of the given transactions by looking it up
+    in the given index of card ids, and returns a pair of
+
+    - an array of card codes (positions in `cards_index`), sorted, and
+    - a data frame with the given columns of the transactions belonging to
+      those cards, in the same (sorted) order.
+
+    Transactions for cards not in `cards_index` are dropped. This is the one
+    sorted view that all the aggregations below are computed from.
+    '''
+    card_codes = cards_index.get_indexer(trans_df['card_id'])
+    rows = np.flatnonzero(card_codes >= 0)
+    rows = rows[np.argsort(card_codes[rows], kind='mergesort')]
+    return card_codes[rows], trans_df[column_names].iloc[rows]
+
+
+def lookup_positions(keys, index):
+    '''Returns the positions of the given series of keys in the given index, or
+    -1 for keys that aren't in it (or nan).
+
+    For categorical keys only the categories are looked up, and the positions
+    are then gathered by the keys' codes.
+    '''
+    if keys.dtype.name != 'category':
+        return index.get_indexer(keys)
+    positions = index.get_indexer(keys.cat.categories)
+    codes = keys.cat.codes.values
+    return np.where(codes >= 0, np.take(positions, codes), -1)
+
+
+def take_values(values, positions):
+    '''Returns the values of the given series at the given positions, with nan
+    for positions of -1. Like a left join, this keeps the type of the values,
+    except that integers become floats if there are any nans.'''
+    missing = positions < 0
+    if values.dtype.name == 'category':
+        codes = np.take(values.cat.codes.values, positions)
+        codes[missing] = -1
+        return pd.Categorical.from_codes(codes, dtype=values.dtype)
+    taken = np.take(values.values, positions)
+    if missing.any():
+        if taken.dtype.kind != 'f':
+            taken = taken.astype(np.float64)
+        taken[missing] = np.nan
+    return taken
+
+
+def lookup_columns(keys, table, column_names):
+    '''Returns a map of the given columns of `table` (a data frame with a
+    unique index) to arrays of their values for the given series of keys, i.e.
+    the values a left join of the keys with the table would give.'''
+    positions = lookup_positions(keys, table.index)
+    return {col: take_values(table[col], positions) for col in column_names}
+
+
+def get_ratio_values(trans_df, column_names, lookup=None):
+    '''Returns a map of the given columns to the sorted list of their (non-nan)
+    values in the given transactions. These are the values that get a `_ratio`
+    column in `aggregate_card_features`, so the order of those columns doesn't
+    depend on the order of the transactions (e.g. whether they were cleaned in
+    chunks or not).
+
+    Columns that aren't in the transactions are looked up (see
+    `aggregate_card_features`), for the unique keys only.
+    '''
+    ratio_values = {}
+    for col in column_names:
+        if col in trans_df.columns:
+            values = trans_df[col]
+        else:
+            key, table = lookup
+            keys = pd.Series(trans_df[key].unique())
+            values = pd.Series(lookup_columns(keys, table, [col])[col])
+        ratio_values[col] = sorted(v for v in values.unique() if not pd.isnull(v))
+    return ratio_values
+
+
+def aggregated_feature_names(aggregators={}, ratio_columns=[], top_columns=[], prefix='',
+                             ratio_values={}):
+    '''Returns the names of the columns that `aggregate_card_features` computes
+    with the given arguments, in the same order.'''
+    names = [f'{prefix}{col}_{f}' for col, funcs in aggregators.items() for f in funcs]
+    names += [f'{prefix}{col}_{value}_ratio' for col in ratio_columns for value in ratio_values[col]]
+    names += [f'{prefix}{col}_top' for col in top_columns]
+    return names
+
+
+def select_card_features(names, trans_df, aggregators={}, ratio_columns=[], top_columns=[],
+                         prefix='', ratio_values=None, lookup=None):
+    '''Returns the arguments of `aggregate_card_features` (aggregators, ratio
+    columns, top columns, prefix and ratio values) that compute just those of
+    the given feature names that it would compute with the given arguments.
+
+    Only the ratio values of the ratio columns that may be among the names are
+    determined (if they aren't given), and only the ratio values that are among
+    the names are kept, so no other ratio columns get computed.
+    '''
+    names = set(names)
+    selected_aggregators = {}
+    for col, funcs in aggregators.items():
+        funcs = [f for f in funcs if f'{prefix}{col}_{f}' in names]
+        if funcs:
+            selected_aggregators[col] = funcs
+
+    candidates = [col for col in ratio_columns
+                  if any(name.startswith(f'{prefix}{col}_') and name.endswith('_ratio')
+                         for name in names)]
+    if ratio_values is None:
+        ratio_values = get_ratio_values(trans_df, candidates, lookup=lookup)
+    selected_values = {}
+    for col in candidates:
+        values = [v for v in ratio_values[col] if f'{prefix}{col}_{v}_ratio' in names]
+        if values:
+            selected_values[col] = values
+
+    return {'aggregators': selected_aggregators,
+            'ratio_columns': list(selected_values),
+            'top_columns': [col for col in top_columns if f'{prefix}{col}_top' in names],
+            'prefix': prefix,
+            'ratio_values': selected_values}
+
+
+def aggregate_card_features(cards_index, trans_df, aggregators={},
+                            ratio_columns=[], top_columns=[], prefix='',
+                            ratio_values=None, lookup=None):
+    '''This function takes an index of card ids and a data frame of transactions
+    (of which there are multiple for every card), and computes all of the
+    following aggregations from a single sorted view of the transactions:
+
+    - for each column and function in `aggregators` (a map of columns as keys
+      and a list of aggregator functions as values, e.g. mean() or sum() or
+      similar), a `<col>_<func>` column,
+    - for each column in `ratio_columns`, a `<col>_<value>_ratio` column for
+      every (non-nan) value in the transactions, containing the fraction of the
+      card's transactions with that value, and
+    - for each column in `top_columns`, a `<col>_top` column with the most
+      commonly occurring value for that card.
+
+    All column names are prefixed with `prefix`. Returns a new data frame
+    indexed by `cards_index`, with the columns in the order given above.
+
+    The values that get a ratio column are taken from `ratio_values` if given
+    (see `get_ratio_values`), which is what makes the result for a subset of
+    the transactions line up with the one for all of them.
+
+    If `lookup` is given, it's a pair of a key column of the transactions (e.g.
+    `merchant_id`) and a data frame indexed by that key (e.g. the merchants).
+    Columns that aren't in the transactions are then taken from that data frame
+    for the key of every transaction, but only for the transactions in the
+    sorted view, so they never need to be joined to the whole table.
+    '''
+    if ratio_values is None:
+        ratio_values = get_ratio_values(trans_df, ratio_columns, lookup=lookup)
+
+    column_names = list(dict.fromkeys(
+        list(aggregators) + list(ratio_columns) + list(top_columns)))
+    looked_up = [col for col in column_names if col not in trans_df.columns]
+    if looked_up and lookup is not None:
+        key, table = lookup
+        column_names = [col for col in column_names if col not in looked_up]
+        if key not in column_names:
+            column_names.append(key)
+    n_cards = len(cards_index)
+    codes, view = group_transactions_by_card(cards_index, trans_df, column_names)
+    if looked_up and lookup is not None:
+        view = view.assign(**lookup_columns(view[key], table, looked_up))
+    # Columns may be stored as float32 to save memory (see `loaders`), but we
+    # want to compute the aggregations with full precision.
+    view = view.astype({col: np.float64 for col in aggregators
+                        if view[col].dtype == np.float32})
+    grouped = view.groupby(codes, sort=False)
+    all_cards = np.arange(n_cards)
+
+    features = {}
+
+    if aggregators:
+        aggregated = grouped.agg(aggregators)
+        for col, funcs in aggregators.items():
+            for f in funcs:
+                values = aggregated[col][f].reindex(all_cards)
+                if f in zero_for_missing_aggregators:
+                    values = values.fillna(0)
+                if f in counting_aggregators:
+                    values = values.astype(aggregated[col][f].dtype)
+                features[f'{prefix}{col}_{f}'] = values.values
+
+    for col in ratio_columns:
+        col_codes, uniques = value_codes(view[col])
+        n_values = len(uniques)
+        has_value = col_codes >= 0
+        counts = np.bincount(codes[has_value] * n_values + col_codes[has_value],
+                             minlength=n_cards * n_values).reshape(n_cards, n_values)
+        # Get total occurences of all values for the column.
+        total = counts.sum(axis=1)
+        # Every value of the whole table gets a column, even if it doesn't
+        # occur for any of these cards.
+        values = ratio_values[col]
+        positions = pd.Index(uniques).get_indexer(values)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            for value, pos in zip(values, positions):
+                value_counts = counts[:, pos] if pos >= 0 else np.zeros(n_cards)
+                features[f'{prefix}{col}_{value}_ratio'] = value_counts / total
+
+    for col in top_columns:
+        col_codes, uniques = value_codes(view[col])
+        top = top_value_codes(codes, col_codes, n_cards, len(uniques))
+        # Look up the values for the codes, with nan for cards without any.
+        features[f'{prefix}{col}_top'] = pd.Series(uniques).reindex(top).values
+
+    result = pd.DataFrame(features, index=cards_index, columns=list(features))
+    for col in top_columns:
+        name = f'{prefix}{col}_top'
+        result[name] = result[name].astype('category').cat.as_ordered()
+    return result
+
+
+def add_card_features(df, trans_df, aggregators={}, ratio_columns=[],
+                      top_columns=[], prefix='', ratio_values=None, lookup=None):
+    '''Like `aggregate_card_features`, but for a data frame indexed by card id:
+    returns that data frame with the resulting columns added.
+
+    The columns are joined to it in one go, since adding hundreds of them one by
+    one (in place) leaves a frame of hundreds of blocks, which is slow to work
+    with.
+    '''
+    features = aggregate_card_features(df.index, trans_df,
+                                       aggregators=aggregators,
+                                       ratio_columns=ratio_columns,
+                                       top_columns=top_columns,
+                                       prefix=prefix,
+                                       ratio_values=ratio_values,
+                                       lookup=lookup)
+    return df.join(features)
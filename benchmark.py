@@ -0,0 +1,292 @@
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from instrumentation import add_instrumentation_arguments, configure_from_args, recording, stage
+
+
+# The sizes of the real Kaggle data, which the default scale of 1.0 stands for.
+# The smaller scales keep the same proportions (and skew), so the timings of
+# different scales are comparable per row.
+real_sizes = {
+    'train_cards': 201917,
+    'test_cards': 123623,
+    'merchants': 334633,
+    # Mean number of transactions per card in both tables.
+    'historical_per_card': 89.6,
+    'new_per_card': 6.0,
+}
+
+
+def transactions_per_card(rng, n_cards, mean, max_count):
+    '''Returns a heavy-tailed number of transactions for each of `n_cards` cards
+    with about the given mean: most cards have a handful of transactions and a
+    few have thousands, like in the real data.'''
+    counts = np.ceil(rng.lognormal(mean=0, sigma=1.2, size=n_cards) * mean / np.exp(1.2 ** 2 / 2))
+    return np.clip(counts, 1, max_count).astype(np.int64)
+
+
+def generate_merchants(rng, merchant_ids):
+    '''Returns a data frame of merchants with the schema of the Kaggle
+    `merchants.csv`, with the same quirks `clean_merchants` deals with: some
+    duplicated merchant ids whose duplicate has group id 35, merchants without
+    a city (and so without `category_2`), and a few with missing lag data.'''
+    n = len(merchant_ids)
+    merchants = pd.DataFrame({
+        'merchant_id': merchant_ids,
+        'merchant_group_id': rng.zipf(1.5, n).clip(1, 112586),
+        'merchant_category_id': rng.randint(-1, 892, n),
+        'subsector_id': rng.randint(-1, 41, n),
+        'numerical_1': np.round(rng.exponential(0.1, n) - 0.057, 6),
+        'numerical_2': np.round(rng.exponential(0.1, n) - 0.057, 6),
+        'category_1': rng.choice(['N', 'Y'], n, p=[0.98, 0.02]),
+        'most_recent_sales_range': rng.choice(list('ABCDE'), n, p=[0.01, 0.02, 0.06, 0.35, 0.56]),
+        'most_recent_purchases_range': rng.choice(list('ABCDE'), n, p=[0.01, 0.02, 0.06, 0.35, 0.56]),
+    })
+    for lag in [3, 6, 12]:
+        merchants[f'avg_sales_lag{lag}'] = np.round(rng.lognormal(0, 0.5, n), 2)
+        merchants[f'avg_purchases_lag{lag}'] = np.round(rng.lognormal(0, 0.5, n), 6)
+        merchants[f'active_months_lag{lag}'] = rng.randint(1, lag + 1, n)
+    merchants['category_4'] = rng.choice(['N', 'Y'], n, p=[0.71, 0.29])
+    merchants['city_id'] = rng.randint(1, 348, n)
+    merchants['state_id'] = rng.randint(1, 25, n)
+    merchants['category_2'] = rng.choice([1., 2., 3., 4., 5.], n)
+
+    # About a third of the merchants have an unknown city and state, and then
+    # `category_2` is always missing, too.
+    no_city = rng.rand(n) < 0.3
+    merchants.loc[no_city, ['city_id', 'state_id']] = -1
+    merchants.loc[no_city, 'category_2'] = np.nan
+
+    # A few merchants have missing lag data.
+    merchants.loc[rng.choice(n, max(1, n // 20000), replace=False), 'avg_sales_lag3'] = np.nan
+
+    # Some merchant ids occur twice, with the duplicate having group id 35.
+    duplicates = merchants.iloc[rng.choice(n, max(1, n // 5000), replace=False)].copy()
+    duplicates['merchant_group_id'] = 35
+    return pd.concat([merchants, duplicates]).sample(frac=1, random_state=rng)
+
+
+def generate_transactions(rng, card_ids, merchant_ids, per_card, start, months,
+                          month_lags, nan_merchants):
+    '''Returns a data frame of transactions with the schema of the Kaggle
+    transactions csvs for the given cards, with a heavy-tailed number of
+    transactions per card (about `per_card` on average), purchase dates in the
+    `months` months after `start`, month lags drawn from `month_lags`, and the
+    given fraction of transactions without a merchant.'''
+    counts = transactions_per_card(rng, len(card_ids), per_card, max_count=int(per_card * 60))
+    cards = np.repeat(card_ids, counts)
+    n = len(cards)
+
+    # Cards mostly shop at the same few merchants, popular ones more often.
+    popularity = rng.zipf(1.3, len(merchant_ids)).clip(1, 10000).astype(np.float64)
+    merchants = rng.choice(merchant_ids, n, p=popularity / popularity.sum()).astype(object)
+    merchants[rng.rand(n) < nan_merchants] = np.nan
+
+    seconds = rng.randint(0, months * 30 * 86400, n)
+    dates = pd.Timestamp(start) + pd.to_timedelta(seconds, unit='s')
+
+    return pd.DataFrame({
+        'authorized_flag': rng.choice(['Y', 'N'], n, p=[0.91, 0.09]),
+        'card_id': cards,
+        'city_id': rng.randint(-1, 348, n),
+        'category_1': rng.choice(['N', 'Y'], n, p=[0.93, 0.07]),
+        'installments': rng.choice([-1, 0, 1, 2, 3, 4, 5, 6, 10, 12, 999], n,
+                                   p=[0.01, 0.52, 0.41, 0.02, 0.015, 0.005, 0.005,
+                                      0.005, 0.004, 0.005, 0.001]),
+        'category_3': rng.choice(['A', 'B', 'C', None], n, p=[0.53, 0.41, 0.05, 0.01]),
+        'merchant_category_id': rng.randint(-1, 892, n),
+        'merchant_id': merchants,
+        'month_lag': rng.choice(month_lags, n),
+        'purchase_amount': np.round(rng.lognormal(-1, 1.5, n) / 100 - 0.75, 8),
+        'purchase_date': dates.strftime('%Y-%m-%d %H:%M:%S'),
+        'category_2': rng.choice([1., 2., 3., 4., 5., np.nan], n,
+                                 p=[0.52, 0.03, 0.14, 0.1, 0.12, 0.09]),
+        'state_id': rng.randint(-1, 25, n),
+        'subsector_id': rng.randint(-1, 41, n),
+    })
+
+
+def generate_cards(rng, card_ids, with_target):
+    '''Returns a data frame of cards with the schema of the Kaggle train (or, if
+    not `with_target`, test) csv, including the ~1% outliers with a target of
+    about -33.2.'''
+    n = len(card_ids)
+    months = pd.Timestamp('2011-11-01') + pd.to_timedelta(rng.randint(0, 76 * 30, n), unit='D')
+    cards = pd.DataFrame({
+        'first_active_month': months.strftime('%Y-%m'),
+        'card_id': card_ids,
+        'feature_1': rng.randint(1, 6, n),
+        'feature_2': rng.randint(1, 4, n),
+        'feature_3': rng.randint(0, 2, n),
+    })
+    if with_target:
+        target = rng.normal(0, 1.7, n)
+        target[rng.rand(n) < 0.011] = -33.21928095
+        cards['target'] = target
+    return cards
+
+
+def generate_data(data_dir, scale=0.01, seed=0):
+    '''Writes synthetic versions of the Kaggle csvs (merchants.csv,
+    historical_transactions.csv, new_merchant_transactions.csv, train.csv and
+    test.csv) with the given scale relative to the real data to the given
+    directory.'''
+    rng = np.random.RandomState(seed)
+    os.makedirs(data_dir, exist_ok=True)
+
+    n_train = max(1, int(real_sizes['train_cards'] * scale))
+    n_test = max(1, int(real_sizes['test_cards'] * scale))
+    n_merchants = max(10, int(real_sizes['merchants'] * scale))
+    card_ids = np.array([f'C_ID_{i:010x}' for i in rng.permutation(n_train + n_test)])
+    merchant_ids = np.array([f'M_ID_{i:010x}' for i in range(n_merchants)])
+
+    print(f'Generating data for {n_train + n_test} cards and {n_merchants} merchants ...')
+    generate_merchants(rng, merchant_ids).to_csv(
+        os.path.join(data_dir, 'merchants.csv'), index=False)
+    generate_transactions(rng, card_ids, merchant_ids, real_sizes['historical_per_card'],
+                          start='2017-01-01', months=14, month_lags=np.arange(-13, 1),
+                          nan_merchants=0.005).to_csv(
+        os.path.join(data_dir, 'historical_transactions.csv'), index=False)
+    # Not every card has new merchant transactions.
+    new_cards = card_ids[rng.rand(len(card_ids)) < 0.9]
+    generate_transactions(rng, new_cards, merchant_ids, real_sizes['new_per_card'],
+                          start='2018-03-01', months=2, month_lags=[1, 2],
+                          nan_merchants=0.013).to_csv(
+        os.path.join(data_dir, 'new_merchant_transactions.csv'), index=False)
+    generate_cards(rng, card_ids[:n_train], with_target=True).to_csv(
+        os.path.join(data_dir, 'train.csv'), index=False)
+    generate_cards(rng, card_ids[n_train:], with_target=False).to_csv(
+        os.path.join(data_dir, 'test.csv'), index=False)
+
+
+def run_benchmark(data_dir, workdir):
+    '''Runs all stages of the pipeline (in memory, the way the Makefile runs
+    them) on the Kaggle-like csvs in `data_dir`, writing intermediate files to
+    `workdir`, and returns the records of all stages (see `instrumentation`).'''
+    # These import fastai (via `clean_transactions`), so only import them here,
+    # so that generating data works without it.
+    from clean_merchants import clean_merchants
+    from clean_transactions import (add_time_since_last_purchase,
+                                    add_time_since_last_purchase_with_merchant,
+                                    prepare_transactions)
+    from feature_engineering import process_data
+    from join_transactions_and_merchants import (join_transactions_with_merchants,
+                                                 merchant_lookup_table,
+                                                 rename_transaction_columns)
+    from loaders import load_cards, load_transactions
+
+    with recording() as records:
+        merchants_df = clean_merchants(os.path.join(workdir, 'merchants.parquet'),
+                                       merchants_csv=os.path.join(data_dir, 'merchants.csv'))
+
+        tables = {}
+        for table in ['historical_transactions', 'new_merchant_transactions']:
+            with stage(table):
+                trans_df = load_transactions(os.path.join(data_dir, f'{table}.csv'))
+                prepare_transactions(trans_df)
+                with stage('sort_by_date', trans_df):
+                    trans_df.sort_values(by=['purchase_Elapsed'], kind='mergesort', inplace=True)
+                add_time_since_last_purchase(trans_df)
+                add_time_since_last_purchase_with_merchant(trans_df)
+                joined_df = join_transactions_with_merchants(trans_df, merchants_df)
+            tables[table] = (trans_df, joined_df)
+
+        train_df = load_cards(os.path.join(data_dir, 'train.csv'))
+        with stage('joined'):
+            process_data(train_df,
+                         tables['historical_transactions'][1],
+                         tables['new_merchant_transactions'][1])
+        # The Makefile looks up the merchant columns instead of joining them.
+        with stage('lookup'):
+            process_data(train_df,
+                         rename_transaction_columns(tables['historical_transactions'][0]),
+                         rename_transaction_columns(tables['new_merchant_transactions'][0]),
+                         merchants_df=merchant_lookup_table(merchants_df))
+
+    return records
+
+
+def git_commit():
+    '''Returns the hash of the checked out commit (with a '+' if there are
+    uncommitted changes), or None if this isn't a git checkout.'''
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], text=True,
+                                         cwd=repo_dir, stderr=subprocess.DEVNULL).strip()
+        dirty = subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'],
+                                        text=True, cwd=repo_dir, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ('+' if dirty else '')
+
+
+def compare_reports(report, baseline):
+    '''Prints the time and peak RSS of every stage of the given report next to
+    those of the given baseline report.'''
+    base_stages = {s['stage']: s for s in baseline['stages']}
+    print(f'{"stage":<90} {"seconds":>18} {"peak RSS (MB)":>22}')
+    for s in report['stages']:
+        b = base_stages.get(s['stage'])
+        if b is None:
+            print(f'{s["stage"]:<90} {s["seconds"]:>18.2f} {s["peak_rss_mb"]:>22.1f}')
+            continue
+        ratio = s['seconds'] / b['seconds'] if b['seconds'] else float('nan')
+        print(f'{s["stage"]:<90} {b["seconds"]:>7.2f} -> {s["seconds"]:>7.2f} ({ratio:4.2f}x)'
+              f' {b["peak_rss_mb"]:>9.1f} -> {s["peak_rss_mb"]:>9.1f}')
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark the pipeline on synthetic data shaped like the Kaggle data.")
+    parser.add_argument('--scale', type=float, default=0.01,
+                        help='Size of the synthetic data relative to the real data.')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed of the random data.')
+    parser.add_argument('--data_dir', type=str, default=None,
+                        help='Directory of the synthetic csvs. They\'re generated if it doesn\'t '
+                             'exist yet, and reused otherwise (so runs compare the same data). '
+                             'Defaults to a temporary directory.')
+    parser.add_argument('--report', type=str, default='benchmark.json',
+                        help='Filename of the json report.')
+    parser.add_argument('--compare', type=str, default=None,
+                        help='Filename of an earlier report to compare the results to.')
+    add_instrumentation_arguments(parser)
+    args = vars(parser.parse_args())
+    configure_from_args(args)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_dir = args['data_dir'] or os.path.join(tmp_dir, 'data')
+        if not os.path.exists(data_dir):
+            generate_data(data_dir, scale=args['scale'], seed=args['seed'])
+
+        start = time.perf_counter()
+        stages = run_benchmark(data_dir, tmp_dir)
+        report = {'commit': git_commit(),
+                  'created': datetime.now().isoformat(timespec='seconds'),
+                  'scale': args['scale'],
+                  'seed': args['seed'],
+                  'rows': {name[:-len('.csv')]: sum(1 for _ in open(os.path.join(data_dir, name))) - 1
+                           for name in sorted(os.listdir(data_dir)) if name.endswith('.csv')},
+                  'versions': {'python': platform.python_version(),
+                               'numpy': np.__version__,
+                               'pandas': pd.__version__},
+                  'total_seconds': round(time.perf_counter() - start, 4),
+                  'stages': stages}
+
+    with open(args['report'], 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'Wrote benchmark report to {args["report"]}')
+
+    if args['compare']:
+        with open(args['compare']) as f:
+            compare_reports(report, json.load(f))
@@ -1,53 +1,58 @@
 import numpy as np
 import pandas as pd
-from pandas.api.types import CategoricalDtype
 
-# A category that can take 'Y' and 'N' values and in addition a value 'Both'
-# to indicate the we've seen both values for this merchant.
-cat_triple = CategoricalDtype(categories = ['Y', 'N', 'Both'])
-
-
-# The features 'most_recent_sales_range' and 'most_recent_purchases_range' take values
-# 'A' to 'E' where 'A' represents the highest amounts. We encode them as categrical data
-# 'A' < 'B' < ...< 'E'.
-cat_most_recent = CategoricalDtype(categories=['E', 'D', 'C', 'B', 'A'], ordered=True)
-
-
-# Takes a series of cat_triple values and returns
-# 'N' if all are 'N',
-# 'Y' if all are "Y',
-# 'Both' otherwise
-def sum_triples(triples):
-    uniques = triples.unique()
-    if 'Both' in uniques:
-        return 'Both'
-    elif 'Y' in uniques:
-        if 'N' in uniques:
-            return 'Both'
-        else:
-            return 'Y'
-    else:
-        return 'N'
-
-
-def clean_merchants(filename = ''):
-    merchants_df = pd.read_csv('data/unzipped/merchants.csv')
+from instrumentation import add_instrumentation_arguments, configure_from_args, instrumented, stage
+from loaders import cat_triple, load_merchants
+from storage import write_frame
+
+
+def sum_triples_by_group(triples, by):
+    '''Sums the given series of cat_triple values for each group of the given
+    keys, i.e. returns 'N' for a group if all its values are 'N', 'Y' if all are
+    'Y', and 'Both' otherwise, keeping the cat_triple type. Groups of only nan
+    values sum to 'N'.
+
+    Since 'Y' < 'N' < 'Both' in the categories of cat_triple, a group sums to a
+    single value exactly when the minimum and maximum of its category codes are
+    the same, and to 'Both' otherwise, so we can do all groups at once.
+    '''
+    codes = pd.Series(triples.cat.codes.values, index=triples.index)
+    grouped = codes.where(codes >= 0).groupby(by, observed=True)
+    lowest, highest = grouped.min(), grouped.max()
+    categories = list(cat_triple.categories)
+    result = np.where(lowest.isnull(), categories.index('N'),
+                      np.where(lowest == highest, lowest, categories.index('Both')))
+    return pd.Series(pd.Categorical.from_codes(result.astype(np.int8), dtype=cat_triple),
+                     index=lowest.index)
+
+
+def max_by_group(values, by):
+    '''Returns the maximum of the given series of ordered categorical values for
+    each group of the given keys (nan for groups of only nan values), keeping
+    the categorical type.'''
+    codes = pd.Series(values.cat.codes.values, index=values.index)
+    highest = codes.where(codes >= 0).groupby(by, observed=True).max()
+    return pd.Series(pd.Categorical.from_codes(highest.fillna(-1).astype(np.int8),
+                                               dtype=values.dtype),
+                     index=highest.index)
+
+
+@instrumented()
+def clean_merchants(filename = '', merchants_csv = 'data/unzipped/merchants.csv'):
+    merchants_df = load_merchants(merchants_csv)
 
     # There are a lot (over 100000) merchants with incomplete city and state data.
     # Since it seems unlikely that the location has an influence on the loyalty, we drop these
     # Also, category_2 is always NaN when the city is unknown, so we drop that, too.
-    merchants_df.drop(columns=['city_id', 'state_id', 'category_2'], inplace=True)
-
-    # There are only 15 merchants where some of the lag data is invalid, so let's just drop these.
-    merchants_df = merchants_df[np.isnan(merchants_df['avg_sales_lag3']) == False]
+    with stage('drop_incomplete_merchants', merchants_df) as record:
+        merchants_df.drop(columns=['city_id', 'state_id', 'category_2'], inplace=True)
 
-    # Category_1 and _4 have only values 'N' and 'Y'. Let's replace this with Booleans False and True
-    merchants_df['category_1'] = merchants_df['category_1'].astype(cat_triple)
-    merchants_df['category_4'] = merchants_df['category_4'].astype(cat_triple)
+        # There are only 15 merchants where some of the lag data is invalid, so let's just drop these.
+        merchants_df = record['output'] = merchants_df[np.isnan(merchants_df['avg_sales_lag3']) == False]
 
-    # The 'most recent' columns measure the size of transactions from 'A' the most to 'E" the least.
-    merchants_df['most_recent_sales_range'] = merchants_df['most_recent_sales_range'].astype(cat_most_recent)
-    merchants_df['most_recent_purchases_range'] = merchants_df['most_recent_purchases_range'].astype(cat_most_recent)
+    # Category_1 and _4 have only values 'N' and 'Y', they're loaded as cat_triple.
+    # The 'most recent' columns measure the size of transactions from 'A' the most to 'E" the least,
+    # they're loaded as cat_most_recent (see `loaders.merchants_dtypes`).
 
     # We need to somehow unify the data for one merchant with several entries.
     # The easiest case is where the all the identifying data is equal.
@@ -71,41 +76,55 @@ def clean_merchants(filename = ''):
     #                   for now I'll take the mean.
     # - active_months_lagX: Take the maximum b/c we're adding transactions.
     # - category_4: 'N' : 'Y' is more than 2:1.
-    grouped = merchants_df.groupby(['merchant_id'])
-
-    # In this grouping the catgory_1 and _4 groups never contain both 'N' and 'Y', but let's accumulate them
-    # with sum_triples to remember it later.
-    aggregated_df = grouped.agg({
-        'merchant_group_id': np.max,
-        'merchant_category_id': 'first',
-        'subsector_id': 'first',
-        'numerical_1': np.mean,
-        'numerical_2': np.mean,
-        'category_1': sum_triples,
-        'most_recent_sales_range': np.max,
-        'most_recent_purchases_range': np.max,
-        'avg_sales_lag3': np.mean,
-        'avg_purchases_lag3': np.mean,
-        'active_months_lag3': np.max,
-        'avg_sales_lag6': np.mean,
-        'avg_purchases_lag6': np.mean,
-        'active_months_lag6': np.max,
-        'avg_sales_lag12': np.mean,
-        'avg_purchases_lag12': np.mean,
-        'active_months_lag12': np.max,
-        'category_4': sum_triples})
-
-    # I don't know how to keep the cat_triple type through sum_triples.
-    aggregated_df['category_1'] = aggregated_df['category_1'].astype(cat_triple)
-    aggregated_df['category_4'] = aggregated_df['category_4'].astype(cat_triple)
-
-    # I especially don't understand why np.max on the values in cat_most_recent transforms
-    # them into str again, but here we go:
-    aggregated_df['most_recent_sales_range'] = aggregated_df['most_recent_sales_range'].astype(cat_most_recent)
-    aggregated_df['most_recent_purchases_range'] = aggregated_df['most_recent_purchases_range'].astype(cat_most_recent)
+    with stage('aggregate_merchants', merchants_df) as record:
+        grouped = merchants_df.groupby(['merchant_id'], observed=True)
+
+        # In this grouping the catgory_1 and _4 groups never contain both 'N' and 'Y', but let's accumulate them
+        # with sum_triples_by_group to remember it later.
+        # The categorical columns are aggregated on their category codes, so they keep their types.
+        aggregated_df = grouped.agg({
+            'merchant_group_id': np.max,
+            'merchant_category_id': 'first',
+            'subsector_id': 'first',
+            'numerical_1': np.mean,
+            'numerical_2': np.mean,
+            'avg_sales_lag3': np.mean,
+            'avg_purchases_lag3': np.mean,
+            'active_months_lag3': np.max,
+            'avg_sales_lag6': np.mean,
+            'avg_purchases_lag6': np.mean,
+            'active_months_lag6': np.max,
+            'avg_sales_lag12': np.mean,
+            'avg_purchases_lag12': np.mean,
+            'active_months_lag12': np.max})
+        merchant_ids = merchants_df['merchant_id']
+        aggregated_df['category_1'] = sum_triples_by_group(merchants_df['category_1'], merchant_ids)
+        aggregated_df['most_recent_sales_range'] = max_by_group(merchants_df['most_recent_sales_range'], merchant_ids)
+        aggregated_df['most_recent_purchases_range'] = max_by_group(merchants_df['most_recent_purchases_range'], merchant_ids)
+        aggregated_df['category_4'] = sum_triples_by_group(merchants_df['category_4'], merchant_ids)
+
+        aggregated_df = aggregated_df[['merchant_group_id',
+                                       'merchant_category_id',
+                                       'subsector_id',
+                                       'numerical_1',
+                                       'numerical_2',
+                                       'category_1',
+                                       'most_recent_sales_range',
+                                       'most_recent_purchases_range',
+                                       'avg_sales_lag3',
+                                       'avg_purchases_lag3',
+                                       'active_months_lag3',
+                                       'avg_sales_lag6',
+                                       'avg_purchases_lag6',
+                                       'active_months_lag6',
+                                       'avg_sales_lag12',
+                                       'avg_purchases_lag12',
+                                       'active_months_lag12',
+                                       'category_4']]
+        record['output'] = aggregated_df
 
     if filename != '':
-        aggregated_df.to_csv(filename)
+        write_frame(aggregated_df, filename)
 
     return aggregated_df
 
@@ -113,7 +132,9 @@ if __name__=="__main__":
     import argparse
 
     parser = argparse.ArgumentParser(description="Clean merchants data.")
-    parser.add_argument('outfile', type=str, help='Filename of the result csv.')
+    parser.add_argument('outfile', type=str, help='Filename of the result (.parquet, .feather or .csv).')
+    add_instrumentation_arguments(parser)
     args = vars(parser.parse_args())
+    configure_from_args(args)
 
     clean_merchants(args['outfile'])
@@ -1,8 +1,69 @@
+import glob
+import os
+import tempfile
+
 import numpy as np
 import pandas as pd
+from pandas.api.types import CategoricalDtype
 from fastai.tabular import add_datepart
 
+from instrumentation import add_instrumentation_arguments, configure_from_args, instrumented, stage
+from loaders import compact_datepart, load_transactions, report_memory, transactions_dtypes
+from partitioning import card_partitions
+from storage import write_frame, write_frames
+
+
+# The fields that we treat as categorical.
+categorical_columns = ['authorized_flag', 'category_1', 'category_2',
+                       'category_3', 'merchant_id', 'merchant_category_id',
+                       'subsector_id', 'city_id', 'state_id']
+
 
+def elapsed_since_last_in_group(transactions_df, group_columns):
+    '''This function calculates, for each transaction, the time passed since
+    the previous transaction in the same group (as given by the values in
+    `group_columns`), or `nan` for the first transaction of every group.
+
+    It computes the same thing as a
+    `groupby(group_columns).agg({'purchase_Elapsed': 'diff'})`, but instead of
+    letting pandas diff every group separately, we encode the group columns as
+    integer codes, do one stable lexsort on them and then compute the diffs for
+    all groups at once, masking out the first row of every group. Since the sort
+    is stable, rows within a group keep their original order, so as long as the
+    data frame is sorted by `purchase_Elapsed` (as it is in the main script),
+    the groups come out sorted by time as well.
+
+    Nan values in any of the group columns get the code -1 and so simply form a
+    group of their own, just like a temporary non-nan category would.
+
+    Returns a float array aligned with the rows of the given data frame.
+    '''
+    codes = [pd.factorize(transactions_df[col])[0] for col in group_columns]
+    elapsed = transactions_df['purchase_Elapsed'].values.astype(np.float64)
+
+    # `np.lexsort` sorts by the last key first, so reverse the group columns.
+    order = np.lexsort(codes[::-1])
+    sorted_elapsed = elapsed[order]
+
+    diffs = np.empty(len(order), dtype=np.float64)
+    diffs[:1] = np.nan
+    diffs[1:] = sorted_elapsed[1:] - sorted_elapsed[:-1]
+
+    # A row starts a new group if any of its codes differs from the row before.
+    group_start = np.zeros(len(order), dtype=bool)
+    group_start[:1] = True
+    for col_codes in codes:
+        sorted_codes = col_codes[order]
+        group_start[1:] |= sorted_codes[1:] != sorted_codes[:-1]
+    diffs[group_start] = np.nan
+
+    # Scatter the diffs back into the original row order.
+    result = np.empty_like(diffs)
+    result[order] = diffs
+    return result
+
+
+@instrumented()
 def add_time_since_last_purchase(transactions_df):
     '''This function calculates, for each purchase, the time passed since the
     time elapsed since the last purchase with that card.
@@ -11,12 +72,11 @@ def add_time_since_last_purchase(transactions_df):
     '''
     print('Computing and adding `elapsed_since_last_purchase` column ...')
 
-    filtered = transactions_df[['card_id', 'purchase_Elapsed']]
-    grouped = filtered.groupby(['card_id'], sort=False)
-    transactions_df['elapsed_since_last_purchase'] = grouped.agg(
-        {'purchase_Elapsed': 'diff'})
+    transactions_df['elapsed_since_last_purchase'] = elapsed_since_last_in_group(
+        transactions_df, ['card_id'])
 
 
+@instrumented()
 def add_time_since_last_purchase_with_merchant(transactions_df):
     '''This function calculates, for each purchase, the time passed since the
     last purchase for that card and merchant combination, e.g. for a transaction
@@ -24,22 +84,180 @@ def add_time_since_last_purchase_with_merchant(transactions_df):
     time passed since I last bought anything at Rewe, or `nan` had I never
     bought anything there.
 
+    Purchases with an unknown (nan) merchant are treated as if they were all
+    made at the same merchant, like any other.
+
+    The given data frame is mutated in place.
+    '''
+    print('Computing and adding `elapsed_since_last_merch_purchase` column ...')
+
+    transactions_df['elapsed_since_last_merch_purchase'] = elapsed_since_last_in_group(
+        transactions_df, ['card_id', 'merchant_id'])
+
+
+@instrumented()
+def prepare_transactions(transactions_df, categories=None):
+    '''This function does all the cleaning of the given (raw) transactions that
+    only looks at one transaction at a time, i.e. making the categorical fields
+    categorical and splitting up the purchase date.
+
+    If `categories` (a map of the columns in `categorical_columns`, and maybe
+    `card_id`, to their categorical dtypes) is given, those dtypes are used,
+    otherwise they're derived from the data.
+
+    The given data frame is mutated in place.
+    '''
+    # Treat categorical fields as categorical.
+    if categories is None:
+        for v in categorical_columns:
+            transactions_df[v] = transactions_df[v].astype('category').cat.as_ordered()
+    else:
+        for v, dtype in categories.items():
+            transactions_df[v] = transactions_df[v].astype(dtype)
+
+    # This function takes a date field and turns it into a bunch of useful
+    # columns, such as "day of week", "is month end", etc. They're all small
+    # integers, so we make them take up less space.
+    add_datepart(transactions_df, 'purchase_date')
+    compact_datepart(transactions_df, 'purchase_')
+
+
+@instrumented()
+def add_times_since_last_purchases(transactions_df, with_merchant=True):
+    '''This function sorts the given (prepared) transactions by date and adds
+    the time since the last purchase with the card (and, if `with_merchant`,
+    with the card at the merchant).
+
+    Since these only depend on the transactions of the same card, this can just
+    as well be done for any subset of cards at a time.
+
     The given data frame is mutated in place.
     '''
-    print('Computing and adding `elapsed_since_last_merch_purchase` column.\n' +
-          'This takes a hell of a long time ...')
+    # Sort by date. The sort is stable so that the result doesn't depend on how
+    # the transactions were split up.
+    with stage('sort_by_date', transactions_df):
+        transactions_df.sort_values(by=['purchase_Elapsed'], kind='mergesort',
+                                    inplace=True)
+
+    # Add new column: time since last purchase (in general or per merchant).
+    add_time_since_last_purchase(transactions_df)
+    if with_merchant:
+        add_time_since_last_purchase_with_merchant(transactions_df)
+
+
+def delta_files(deltas_dir):
+    '''Returns the files of new transactions in the given directory (see
+    `incremental.py update`) in the order they came in, or none if there's no
+    such directory.'''
+    if deltas_dir is None or not os.path.isdir(deltas_dir):
+        return []
+    return [os.path.join(deltas_dir, name) for name in sorted(os.listdir(deltas_dir))
+            if not name.startswith('.')]
+
+
+def load_all_transactions(filenames):
+    '''Loads the raw transactions in the given csvs (see
+    `loaders.load_transactions`) into one data frame.'''
+    if len(filenames) == 1:
+        return load_transactions(filenames[0])
+    trans_df = pd.concat([load_transactions(filename) for filename in filenames],
+                         ignore_index=True)
+    # The columns whose categories come from the data got different ones for
+    # every file.
+    return trans_df.astype({v: dtype for v, dtype in transactions_dtypes.items()
+                            if dtype == 'category'})
+
+
+@instrumented()
+def scan_categories(filenames, chunksize):
+    '''Reads the categorical fields (and the card ids) of the given transactions
+    csvs in chunks and returns a pair of a map of those fields to their
+    categorical dtypes (the same categories that `astype('category')` would have
+    given us for all files at once) and the total number of transactions.
+    '''
+    columns = categorical_columns + ['card_id']
+    uniques = {v: set() for v in columns}
+    n_rows = 0
+    for filename in filenames:
+        for chunk in pd.read_csv(filename, usecols=columns, chunksize=chunksize,
+                                 dtype={v: transactions_dtypes[v] for v in columns}):
+            n_rows += len(chunk)
+            for v in columns:
+                uniques[v].update(chunk[v].dropna().unique())
+    categories = {v: CategoricalDtype(sorted(values), ordered=v in categorical_columns)
+                  for v, values in uniques.items()}
+    return categories, n_rows
+
+
+def spill_frame(df, filename, categories):
+    '''Pickles the given data frame with the categorical columns in
+    `categories` (a map of columns to their categorical dtypes) stored as their
+    integer codes. The pickle of a categorical column contains all of its
+    categories (e.g. all card ids of the file), which we don't want to write
+    for every spilled piece. See `read_spilled_frames` for getting them back.
+    '''
+    df.assign(**{v: df[v].cat.codes for v in categories}).to_pickle(filename)
+
 
-    # Since `merchant_id` can be nan, we need to treat those as non-nan
-    # temporarily in order not to drop rows when grouping. We also filter the
-    # data frame, since we are only interested in these three columns.
-    filtered = transactions_df[['card_id', 'merchant_id', 'purchase_Elapsed']]
-    filtered['merchant_id'] = filtered['merchant_id'].cat.add_categories(
-        'temp_nan').fillna('temp_nan')
-    grouped = filtered.groupby(['card_id', 'merchant_id'], sort=False)
+def read_spilled_frames(filenames, categories):
+    '''Reads the data frames in the given files written by `spill_frame` (with
+    the same `categories`) and returns them concatenated, with the categorical
+    dtypes of the columns restored.'''
+    df = pd.concat([pd.read_pickle(f) for f in filenames])
+    for v, dtype in categories.items():
+        df[v] = pd.Categorical.from_codes(df[v], dtype=dtype)
+    return df
 
-    # This takes a hell of a long time.
-    transactions_df['elapsed_since_last_merch_purchase'] = grouped.agg(
-        {'purchase_Elapsed': 'diff'})
+
+@instrumented()
+def clean_transactions_in_chunks(filenames, outfile, chunksize,
+                                 with_merchant=True, tmpdir=None):
+    '''This function does the same as the main script below for the
+    transactions in the given csvs, but without ever loading them all into
+    memory:
+
+    1. It scans the files once for the categories of the categorical fields, so
+       that every chunk gets the same categorical dtypes.
+    2. It reads the files in chunks of `chunksize` rows, prepares every chunk and
+       spills its rows to disk, hash partitioned on `card_id` into about as
+       many partitions as there are chunks.
+    3. It loads one partition (i.e. all transactions of a subset of the cards)
+       at a time, adds the times since the last purchases, and appends it to the
+       result file.
+
+    So peak memory depends on the chunk size rather than the size of the files.
+    The result contains the same rows as the in-memory version, but they're only
+    sorted by date within each partition.
+    '''
+    print(f'Scanning {", ".join(filenames)} for categories ...')
+    categories, n_rows = scan_categories(filenames, chunksize)
+    n_partitions = max(1, -(-n_rows // chunksize))
+
+    with tempfile.TemporaryDirectory(dir=tmpdir) as spill_dir:
+        print(f'Splitting {n_rows} transactions into {n_partitions} partitions ...')
+        chunks = (chunk for filename in filenames
+                  for chunk in load_transactions(filename, chunksize=chunksize))
+        for i, chunk in enumerate(chunks):
+            prepare_transactions(chunk, categories)
+            with stage('spill_chunk', chunk):
+                partitions = card_partitions(chunk['card_id'], n_partitions)
+                for p, piece in chunk.groupby(partitions):
+                    spill_frame(piece, os.path.join(spill_dir, f'{p:05d}-{i:05d}.pkl'),
+                                categories)
+
+        def cleaned_partitions():
+            for p in range(n_partitions):
+                pieces = sorted(glob.glob(os.path.join(spill_dir, f'{p:05d}-*.pkl')))
+                if not pieces:
+                    continue
+                with stage('load_partition') as record:
+                    partition_df = record['output'] = read_spilled_frames(pieces, categories)
+                for f in pieces:
+                    os.remove(f)
+                add_times_since_last_purchases(partition_df, with_merchant)
+                yield partition_df
+
+        write_frames(cleaned_partitions(), outfile)
 
 
 if __name__ == "__main__":
@@ -50,34 +268,38 @@ if __name__ == "__main__":
     parser.add_argument('transactions_csv', type=str,
                         help='Filename of the transactions csv.')
     parser.add_argument('outfile', type=str,
-                        help='Filename of the result csv.')
+                        help='Filename of the result (.parquet, .feather or .csv).')
     parser.add_argument('--calculate_time_since_purchase_with_merchant', action='store_true',
                         help='Whether or not to calculate time passed since card owner\'s last purchase with merchant.')
+    parser.add_argument('--chunksize', type=int, default=None,
+                        help='If given, process the transactions in chunks of this many rows '
+                             'instead of loading them all into memory at once.')
+    parser.add_argument('--tmpdir', type=str, default=None,
+                        help='Directory for the temporary files of the chunked mode.')
+    parser.add_argument('--deltas_dir', type=str, default=None,
+                        help='Directory of csvs of transactions that came in after the ones in '
+                             'transactions_csv (see incremental.py update), to clean along with '
+                             'them. It\'s fine if the directory doesn\'t exist (yet).')
     parser.set_defaults(calculate_time_since_purchase_with_merchant=True)
+    add_instrumentation_arguments(parser)
     args = vars(parser.parse_args())
-
-    trans_df = pd.read_csv(args['transactions_csv'],
-                           parse_dates=['purchase_date'])
+    configure_from_args(args)
 
     # Suppress an annoying warning.
     pd.options.mode.chained_assignment = None  # default='warn'
 
-    # Treat categorical fields as categorical.
-    for v in ['authorized_flag', 'category_1', 'category_2', 'category_3',
-              'merchant_id', 'merchant_category_id', 'subsector_id', 'city_id',
-              'state_id']:
-        trans_df[v] = trans_df[v].astype('category').cat.as_ordered()
-
-    # This function takes a date field and turns it into a bunch of useful
-    # columns, such as "day of week", "is month end", etc.
-    add_datepart(trans_df, 'purchase_date')
-
-    # Sort by date.
-    trans_df.sort_values(by=['purchase_Elapsed'], inplace=True)
-
-    # Add new column: time since last purchase (in general or per merchant).
-    add_time_since_last_purchase(trans_df)
-    if args['calculate_time_since_purchase_with_merchant']:
-        add_time_since_last_purchase_with_merchant(trans_df)
+    with_merchant = args['calculate_time_since_purchase_with_merchant']
+    filenames = [args['transactions_csv']] + delta_files(args['deltas_dir'])
 
-    trans_df.to_csv(args['outfile'])
+    if args['chunksize']:
+        clean_transactions_in_chunks(filenames,
+                                     args['outfile'],
+                                     args['chunksize'],
+                                     with_merchant=with_merchant,
+                                     tmpdir=args['tmpdir'])
+    else:
+        trans_df = load_all_transactions(filenames)
+        prepare_transactions(trans_df)
+        add_times_since_last_purchases(trans_df, with_merchant)
+        report_memory(trans_df, 'Cleaned transactions')
+        write_frame(trans_df, args['outfile'])
@@ -0,0 +1,65 @@
+import ast
+import glob
+import hashlib
+import json
+import os
+
+from storage import read_frame, write_frame
+
+
+def file_digest(filename, block_size=2**24):
+    '''Returns the sha1 hex digest of the contents of the given file.'''
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def code_digest(filename):
+    '''Returns a digest of the code in the given python file that ignores
+    comments and formatting, so that edits that don't change the code don't
+    change the digest either.'''
+    with open(filename) as f:
+        tree = ast.parse(f.read(), filename)
+    return hashlib.sha1(ast.dump(tree).encode('utf-8')).hexdigest()
+
+
+def cache_key(filenames, spec):
+    '''Returns a key for results computed from the given input files with the
+    given spec (anything json serializable, e.g. the aggregators used and a
+    digest of the code computing them, see `code_digest`). The key only changes
+    if the contents of one of the files or the spec change.'''
+    key = json.dumps({'files': [file_digest(f) for f in filenames],
+                      'spec': spec},
+                     sort_keys=True, default=str)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def cache_filename(cache_dir, key):
+    return os.path.join(cache_dir, f'card_features-{key}.parquet')
+
+
+def read_cached_features(cache_dir, key):
+    '''Returns the data frame of per-card features (indexed by card id) stored
+    under the given key, or None if there isn't one.'''
+    filename = cache_filename(cache_dir, key)
+    if not os.path.exists(filename):
+        return None
+    return read_frame(filename)
+
+
+def write_cached_features(cache_dir, key, features):
+    '''Stores the given data frame of per-card features (indexed by card id)
+    under the given key, replacing what was stored there before. The features
+    stored under other keys are removed, since they're out of date.'''
+    os.makedirs(cache_dir, exist_ok=True)
+    filename = cache_filename(cache_dir, key)
+    # Write to a temporary file first, so an interrupted run can't leave a
+    # broken cache file behind.
+    tmp_filename = os.path.join(cache_dir, f'card_features-{key}.tmp.parquet')
+    write_frame(features, tmp_filename)
+    os.replace(tmp_filename, filename)
+    for stale in glob.glob(os.path.join(cache_dir, 'card_features-*')):
+        if stale != filename:
+            os.remove(stale)
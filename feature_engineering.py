@@ -1,7 +1,124 @@
+import os
+
 import pandas as pd
 import numpy as np
 from fastai.tabular import add_datepart
 
+from aggregation import (add_card_features, aggregate_card_features, aggregated_feature_names,
+                         get_ratio_values, select_card_features)
+from feature_cache import cache_key, code_digest, read_cached_features, write_cached_features
+from feature_matrix import card_feature_names, target_column, write_feature_matrix
+from instrumentation import add_instrumentation_arguments, configure_from_args, instrumented, stage
+from join_transactions_and_merchants import merchant_lookup_table, rename_transaction_columns
+from loaders import compact_datepart, load_cards, load_processed
+from partitioning import card_partitions
+from storage import write_frame
+
+
+# We do feature engineering by aggregating data from the transactions tables.
+# All the aggregations for one table are computed from a single view of the
+# table grouped by card (see `aggregation.aggregate_card_features`).
+#
+# The transactions tables are either the ones joined with the merchants, or the
+# cleaned ones along with the merchants (see `load_transaction_data`), in which
+# case the merchant columns are looked up by merchant id only for the columns
+# and transactions that are aggregated.
+
+aggs = {
+    'purchase_amount': ['sum', 'mean', 'min', 'max', 'std'],
+    'installments': ['sum', 'mean', 'min', 'max', 'std'],
+    'month_lag': ['mean', 'min', 'max'],
+    'merchant_id': ['nunique'],
+    'state_id': ['nunique'],
+    'city_id': ['nunique'],
+    'numerical_1': ['sum', 'mean', 'min', 'max', 'std'],
+    'numerical_2': ['sum', 'mean', 'min', 'max', 'std'],
+    'avg_sales_lag3': ['sum', 'mean', 'min', 'max', 'std'],
+    'avg_sales_lag6': ['sum', 'mean', 'min', 'max', 'std'],
+    'avg_sales_lag12': ['sum', 'mean', 'min', 'max', 'std'],
+    'avg_purchases_lag3': ['sum', 'mean', 'min', 'max', 'std'],
+    'avg_purchases_lag6': ['sum', 'mean', 'min', 'max', 'std'],
+    'avg_purchases_lag12': ['sum', 'mean', 'min', 'max', 'std'],
+    'active_months_lag3': ['sum', 'mean', 'min', 'max', 'std'],
+    'active_months_lag6': ['sum', 'mean', 'min', 'max', 'std'],
+    'active_months_lag12': ['sum', 'mean', 'min', 'max', 'std'],
+    'merchant_category_id_transaction': ['nunique'],
+    'merchant_category_id_merchant': ['nunique'],
+    'subsector_id_transaction': ['nunique'],
+    'subsector_id_merchant': ['nunique'],
+    'merchant_group_id': ['nunique'],
+    'most_recent_sales_range': ['nunique'],
+    'most_recent_purchases_range': ['nunique'],
+    'elapsed_since_last_purchase': ['sum', 'mean', 'min', 'max', 'std'],
+}
+
+# For the categorical fields, we can't aggregate by taking the mean or sum
+# values, so let's count the occurences of each possible categorical value
+# instead. (Iow, for a category that can be either YES or NO, we count the
+# number of YESes and the number of NOs and use those values.)
+ratio_columns = ['authorized_flag',
+                 'category_1_transaction',
+                 'category_1_merchant',
+                 'category_2',
+                 'category_3',
+                 'category_4',
+                 'purchase_Is_month_start',
+                 'purchase_Is_month_end',
+                 'purchase_Year',
+                 'most_recent_sales_range',
+                 'most_recent_purchases_range']
+
+# We also get the top (most common) values for the categorical fields.
+top_columns = ['authorized_flag',
+               'category_1_transaction',
+               'category_1_merchant',
+               'category_2',
+               'category_3',
+               'category_4',
+               'subsector_id_transaction',
+               'subsector_id_merchant',
+               'city_id',
+               'state_id',
+               'purchase_Year',
+               'purchase_Month',
+               'purchase_Week',
+               'purchase_Day',
+               'purchase_Dayofweek',
+               'most_recent_sales_range',
+               'most_recent_purchases_range']
+
+# The historical transactions get a couple of extra aggregations.
+hist_trans_aggs = {
+    'elapsed_since_last_merch_purchase': ['sum', 'mean', 'min', 'max', 'std'],
+}
+
+# The features of both transactions tables, as the arguments of
+# `aggregation.add_card_features` that compute them. `process_data` computes
+# all of them, unless it's given the names of the features to compute, in which
+# case only what those need is computed (see `select_table_features`).
+table_features = {
+    'historical': {'aggregators': {**aggs, **hist_trans_aggs},
+                   'ratio_columns': ratio_columns,
+                   'top_columns': top_columns,
+                   'prefix': ''},
+    'new_merchant': {'aggregators': aggs,
+                     'ratio_columns': ratio_columns,
+                     'top_columns': top_columns,
+                     'prefix': 'merch_'},
+}
+
+
+def _add_card_features_in_place(df, trans_df, **kwargs):
+    '''Adds the features of `aggregation.add_card_features` with the given
+    arguments to the given data frame of cards itself, column by column, for
+    the wrappers below (which the notebooks use).
+
+    The given data frame is modified in place (iow, nothing is returned).
+    '''
+    features = aggregate_card_features(df.index, trans_df, **kwargs)
+    for col in features.columns:
+        df[col] = features[col]
+
 
 def add_aggregated_numerical_fields(df, hist_trans_df, aggregators, prefix=''):
     '''This function takes a data frame of card ids and one of historical
@@ -14,11 +131,7 @@ def add_aggregated_numerical_fields(df, hist_trans_df, aggregators, prefix=''):
 
     The given data frame is modified in place (iow, nothing is returned).
     '''
-    merged = df.merge(hist_trans_df, how='left', on=['card_id'])
-    aggregated = merged.groupby('card_id').agg(aggregators)
-    for col, funcs in aggregators.items():
-        for f in funcs:
-            df[f'{prefix}{col}_{f}'] = aggregated[col][f]
+    _add_card_features_in_place(df, hist_trans_df, aggregators=aggregators, prefix=prefix)
 
 
 def add_aggregated_categorical_fields(df, hist_trans_df, column_names, prefix=''):
@@ -28,29 +141,12 @@ def add_aggregated_categorical_fields(df, hist_trans_df, column_names, prefix=''
     the number of occurrences for each possible value and category.
 
     For instance, if we have a categorical column that can be either 'Y' or 'N',
-    this would create one 'Y_count' and one 'N_count' column, each of which
-    contains the number of occurrences of that value for the given card.
+    this would create one 'Y_ratio' and one 'N_ratio' column, each of which
+    contains the fraction of the card's transactions with that value.
 
     The given data frame is modified in place (iow, nothing is returned).
     '''
-    merged = df.merge(hist_trans_df, how='left', on=['card_id'])
-    for col in column_names:
-        values = hist_trans_df[col].unique()
-        # 0 is not always a good default.
-        counts = merged.groupby(['card_id', col]).size().unstack(fill_value=0)
-        # Get total occurences of all values for the column.
-        total = counts.sum(axis=1)
-        for value in values:
-            # Ignore nan. We should maybe handle this in a better way.
-            if not pd.isnull(value):
-                df[f'{prefix}{col}_{value}_ratio'] = counts[value] / total
-
-
-def get_top_category(row):
-    '''Given a row with some categorical column, return the most commonly
-    occurring value (or NaN if none) for that card id and category.'''
-    mode = row.mode()
-    return mode.iat[0] if len(mode) > 0 else np.nan
+    _add_card_features_in_place(df, hist_trans_df, ratio_columns=column_names, prefix=prefix)
 
 
 def add_top_categories(df, hist_trans_df, column_names, prefix=''):
@@ -58,16 +154,20 @@ def add_top_categories(df, hist_trans_df, column_names, prefix=''):
     transactions (of which there are multiple for every card), and then, for
     each card and each given column, picks out the most commonly occurring value
     for that permutation.
+
+    The given data frame is modified in place (iow, nothing is returned).
     '''
-    merged = df.merge(hist_trans_df, how='left', on=['card_id'])
-    grouped = merged.groupby('card_id')
-    for col in column_names:
-        top_vals = grouped[col].apply(get_top_category)
-        df[f'{prefix}{col}_top'] = top_vals.astype('category').cat.as_ordered()
+    _add_card_features_in_place(df, hist_trans_df, top_columns=column_names, prefix=prefix)
 
 
-def process_data(df, hist_trans_df, merch_trans_df):
-    # Extract more useful information from the `first_active_month` date field.
+@instrumented()
+def add_first_active_month_features(df, features=None):
+    '''Extracts more useful information from the `first_active_month` date
+    field of the given data frame of cards. If the names of the `features` to
+    add are given, only the date parts among them are kept.
+
+    The given data frame is modified in place (iow, nothing is returned).
+    '''
     add_datepart(df, 'first_active_month')
     df.drop(['first_active_monthDay',
              'first_active_monthDayofweek',
@@ -77,132 +177,294 @@ def process_data(df, hist_trans_df, merch_trans_df):
              'first_active_monthIs_quarter_end',
              'first_active_monthIs_year_end'],
             axis=1, inplace=True)
+    compact_datepart(df, 'first_active_month')
+    if features is not None:
+        df.drop([col for col in df.columns
+                 if col.startswith('first_active_month') and col not in features],
+                axis=1, inplace=True)
 
-    # Do feature engineering by aggregating data from the transactions tables.
 
-    aggs = {
-        'purchase_amount': ['sum', 'mean', 'min', 'max', 'std'],
-        'installments': ['sum', 'mean', 'min', 'max', 'std'],
-        'month_lag': ['mean', 'min', 'max'],
-        'merchant_id': ['nunique'],
-        'state_id': ['nunique'],
-        'city_id': ['nunique'],
-        'numerical_1': ['sum', 'mean', 'min', 'max', 'std'],
-        'numerical_2': ['sum', 'mean', 'min', 'max', 'std'],
-        'avg_sales_lag3': ['sum', 'mean', 'min', 'max', 'std'],
-        'avg_sales_lag6': ['sum', 'mean', 'min', 'max', 'std'],
-        'avg_sales_lag12': ['sum', 'mean', 'min', 'max', 'std'],
-        'avg_purchases_lag3': ['sum', 'mean', 'min', 'max', 'std'],
-        'avg_purchases_lag6': ['sum', 'mean', 'min', 'max', 'std'],
-        'avg_purchases_lag12': ['sum', 'mean', 'min', 'max', 'std'],
-        'active_months_lag3': ['sum', 'mean', 'min', 'max', 'std'],
-        'active_months_lag6': ['sum', 'mean', 'min', 'max', 'std'],
-        'active_months_lag12': ['sum', 'mean', 'min', 'max', 'std'],
-        'merchant_category_id_transaction': ['nunique'],
-        'merchant_category_id_merchant': ['nunique'],
-        'subsector_id_transaction': ['nunique'],
-        'subsector_id_merchant': ['nunique'],
-        'merchant_group_id': ['nunique'],
-        'most_recent_sales_range': ['nunique'],
-        'most_recent_purchases_range': ['nunique'],
-        'elapsed_since_last_purchase': ['sum', 'mean', 'min', 'max', 'std'],
-    }
+@instrumented()
+def process_data(df, hist_trans_df, merch_trans_df,
+                 hist_ratio_values=None, merch_ratio_values=None,
+                 merchants_df=None, features=None):
+    '''Returns the given data frame of cards (indexed by card id) with all the
+    features added: date parts of `first_active_month` and aggregations of the
+    cards' historical and new merchant transactions.
+
+    The ratio values (see `aggregation.get_ratio_values`) only need to be given
+    when the transactions are a subset of the full tables. The merchants (see
+    `join_transactions_and_merchants.merchant_lookup_table`) only need to be
+    given when the transactions aren't joined with them.
+
+    If the names of the `features` to add are given, only those are added, and
+    only the aggregations (and merchant lookups) that they need are computed.
+
+    The given data frame itself is left alone.
+    '''
+    df = df.copy()
+    add_first_active_month_features(df, features=features)
+    return add_transaction_features(df, hist_trans_df, merch_trans_df,
+                                    hist_ratio_values=hist_ratio_values,
+                                    merch_ratio_values=merch_ratio_values,
+                                    merchants_df=merchants_df,
+                                    features=features)
+
+
+def merchant_lookup(merchants_df):
+    '''Returns the `lookup` argument of `aggregation.add_card_features` for the
+    given merchants, or None if there aren't any.'''
+    return None if merchants_df is None else ('merchant_id', merchants_df)
+
 
+def select_table_features(table, trans_df, features=None, ratio_values=None, merchants_df=None):
+    '''Returns the arguments of `aggregation.add_card_features` (besides the
+    `lookup`) that compute the given features (all of `table_features` if None)
+    of the given transactions table ('historical' or 'new_merchant'), including
+    the ratio values they need (see `aggregation.get_ratio_values`) if these
+    aren't given.'''
+    spec = table_features[table]
+    lookup = merchant_lookup(merchants_df)
+    if features is not None:
+        return select_card_features(features, trans_df, ratio_values=ratio_values,
+                                    lookup=lookup, **spec)
+    if ratio_values is None:
+        ratio_values = get_ratio_values(trans_df, spec['ratio_columns'], lookup=lookup)
+    return dict(spec, ratio_values=ratio_values)
+
+
+@instrumented()
+def add_transaction_features(df, hist_trans_df, merch_trans_df,
+                             hist_ratio_values=None, merch_ratio_values=None,
+                             merchants_df=None, features=None):
+    '''Returns the given data frame of cards (see `process_data`) with the
+    aggregations of the cards' historical and new merchant transactions added.
+    These only depend on the card ids, not on any other columns of the data
+    frame.
+    '''
+    hist_features = select_table_features('historical', hist_trans_df, features,
+                                          ratio_values=hist_ratio_values,
+                                          merchants_df=merchants_df)
+    merch_features = select_table_features('new_merchant', merch_trans_df, features,
+                                           ratio_values=merch_ratio_values,
+                                           merchants_df=merchants_df)
+
+    # Do feature engineering by aggregating data from the transactions tables.
     # First up we aggregate the data in the `historical_transactions` table.
-    hist_trans_aggs = {
-        'elapsed_since_last_merch_purchase': ['sum', 'mean', 'min', 'max', 'std'],
-    }
-    print('Aggregating numerical fields from the historical transactions ...')
-    add_aggregated_numerical_fields(df,
-                                    hist_trans_df,
-                                    aggregators={**aggs, **hist_trans_aggs})
-
-    # For the categorical fields, we can't aggregate by taking the mean or sum
-    # values, so let's count the occurences of each possible categorical value
-    # instead. (Iow, for a category that can be either YES or NO, we count the
-    # number of YESes and the number of NOs and use those values.)
-    print('Aggregating categorical fields from the historical transactions ...')
-    add_aggregated_categorical_fields(df,
-                                      hist_trans_df,
-                                      column_names=['authorized_flag',
-                                                    'category_1_transaction',
-                                                    'category_1_merchant',
-                                                    'category_2',
-                                                    'category_3',
-                                                    'category_4',
-                                                    'purchase_Is_month_start',
-                                                    'purchase_Is_month_end',
-                                                    'purchase_Year',
-                                                    'most_recent_sales_range',
-                                                    'most_recent_purchases_range'])
-
-    print('Getting top values for categorical fields from the historical transactions ...')
-    add_top_categories(df,
-                       hist_trans_df,
-                       column_names=['authorized_flag',
-                                     'category_1_transaction',
-                                     'category_1_merchant',
-                                     'category_2',
-                                     'category_3',
-                                     'category_4',
-                                     'subsector_id_transaction',
-                                     'subsector_id_merchant',
-                                     'city_id',
-                                     'state_id',
-                                     'purchase_Year',
-                                     'purchase_Month',
-                                     'purchase_Week',
-                                     'purchase_Day',
-                                     'purchase_Dayofweek',
-                                     'most_recent_sales_range',
-                                     'most_recent_purchases_range'])
+    if aggregated_feature_names(**hist_features):
+        print('Aggregating fields from the historical transactions ...')
+        with stage('add_card_features[historical]', hist_trans_df) as record:
+            df = add_card_features(df, hist_trans_df, lookup=merchant_lookup(merchants_df),
+                                   **hist_features)
+            record['output'] = df
 
     # Next we aggregate the data in the `new_merchants_transactions` table.
-    print('Aggregating numerical fields from the new merchant transactions ...')
-    add_aggregated_numerical_fields(df,
-                                    merch_trans_df,
-                                    aggregators=aggs,
-                                    prefix='merch_')
-
-    # These ones don't work for the new_merchant_transactions for some reason
-    # (missing data?), so let's skip them for now ...
-    print('Aggregating categorical fields from the new merchant transactions ...')
-    add_aggregated_categorical_fields(df,
-                                      merch_trans_df,
-                                      column_names=['authorized_flag',
-                                                    'category_1_transaction',
-                                                    'category_1_merchant',
-                                                    'category_2',
-                                                    'category_3',
-                                                    'category_4',
-                                                    'purchase_Is_month_start',
-                                                    'purchase_Is_month_end',
-                                                    'purchase_Year',
-                                                    'most_recent_sales_range',
-                                                    'most_recent_purchases_range'],
-                                      prefix='merch_')
-
-    print('Getting top values for categorical fields from the new merchant transactions ...')
-    add_top_categories(df,
-                       merch_trans_df,
-                       column_names=['authorized_flag',
-                                     'category_1_transaction',
-                                     'category_1_merchant',
-                                     'category_2',
-                                     'category_3',
-                                     'category_4',
-                                     'subsector_id_transaction',
-                                     'subsector_id_merchant',
-                                     'city_id',
-                                     'state_id',
-                                     'purchase_Year',
-                                     'purchase_Month',
-                                     'purchase_Week',
-                                     'purchase_Day',
-                                     'purchase_Dayofweek',
-                                     'most_recent_sales_range',
-                                     'most_recent_purchases_range'],
-                       prefix='merch_')
+    if aggregated_feature_names(**merch_features):
+        print('Aggregating fields from the new merchant transactions ...')
+        with stage('add_card_features[new_merchant]', merch_trans_df) as record:
+            df = add_card_features(df, merch_trans_df, lookup=merchant_lookup(merchants_df),
+                                   **merch_features)
+            record['output'] = df
+
+    return df
+
+
+# The data the worker processes of `process_data_in_parallel` work on. They're
+# set before the worker processes are forked, so the workers share them with
+# the parent process instead of getting a pickled copy of the whole tables.
+_partitioned = {}
+
+
+def _process_partition(p):
+    '''Runs the function in `_partitioned` on partition `p` of the data in
+    `_partitioned` and returns the resulting data frame.'''
+    data = _partitioned
+    return data['process'](data['df'][data['df_parts'] == p],
+                           data['hist_trans_df'][data['hist_trans_parts'] == p],
+                           data['merch_trans_df'][data['merch_trans_parts'] == p],
+                           hist_ratio_values=data['hist_ratio_values'],
+                           merch_ratio_values=data['merch_ratio_values'],
+                           merchants_df=data['merchants_df'],
+                           features=data['features'])
+
+
+@instrumented()
+def process_data_in_parallel(df, hist_trans_df, merch_trans_df, n_workers,
+                             process=process_data, merchants_df=None, features=None):
+    '''Does the same as `process_data` (or `process`, which has to take the same
+    arguments, e.g. `add_transaction_features`), but in `n_workers` processes.
+
+    All features of a card only depend on that card's own transactions, so we
+    hash partition the cards and both transactions tables by card id, run
+    `process_data` on every partition in a process pool, and then put the
+    results back together in the original order of the cards. The result is the
+    same as that of a serial run.
+    '''
+    import multiprocessing
+
+    print(f'Partitioning the data by card for {n_workers} workers ...')
+    _partitioned.update(
+        process=process,
+        df=df,
+        df_parts=card_partitions(df.index.values, n_workers),
+        hist_trans_df=hist_trans_df,
+        hist_trans_parts=card_partitions(hist_trans_df['card_id'], n_workers),
+        merch_trans_df=merch_trans_df,
+        merch_trans_parts=card_partitions(merch_trans_df['card_id'], n_workers),
+        merchants_df=merchants_df,
+        features=features,
+        # Every partition needs ratio columns for the values in the whole tables.
+        hist_ratio_values=select_table_features('historical', hist_trans_df, features,
+                                                merchants_df=merchants_df)['ratio_values'],
+        merch_ratio_values=select_table_features('new_merchant', merch_trans_df, features,
+                                                 merchants_df=merchants_df)['ratio_values'])
+    partitions = np.unique(_partitioned['df_parts'])
+
+    try:
+        with multiprocessing.get_context('fork').Pool(n_workers) as pool:
+            results = pool.map(_process_partition, partitions)
+    finally:
+        _partitioned.clear()
+
+    result = pd.concat(results).loc[df.index]
+
+    # The top values of the partitions all got their own categories, so we
+    # turn them into the categories over all cards again.
+    for col in result.columns:
+        if col.endswith('_top'):
+            result[col] = result[col].astype('category').cat.as_ordered()
+
+    return result
+
+
+# The modules whose code computes the transaction features, see `feature_spec`.
+feature_code_files = ['aggregation.py', 'feature_engineering.py',
+                      'join_transactions_and_merchants.py']
+
+
+def feature_spec(features=None):
+    '''Returns everything that determines the transaction features of a card
+    besides the transactions themselves, for use in a cache key: the
+    aggregations and the code that computes them, so that a fix to that code
+    doesn't keep using the features cached before.'''
+    code_dir = os.path.dirname(os.path.abspath(__file__))
+    spec = {'aggs': aggs,
+            'hist_trans_aggs': hist_trans_aggs,
+            'ratio_columns': ratio_columns,
+            'top_columns': top_columns,
+            'code': {filename: code_digest(os.path.join(code_dir, filename))
+                     for filename in feature_code_files}}
+    if features is not None:
+        spec['features'] = sorted(features)
+    return spec
+
+
+def load_transaction_data(hist_trans_file, merch_trans_file, merchants_file=None):
+    '''Loads the transactions tables from the given files, and returns them
+    along with the merchants to look up their merchant columns in (see
+    `join_transactions_and_merchants.merchant_lookup_table`).
+
+    If `merchants_file` isn't given, the transactions have to be joined with
+    the merchants already, and the merchants returned are None.
+    '''
+    hist_trans_df = load_processed(hist_trans_file)
+    merch_trans_df = load_processed(merch_trans_file)
+    if merchants_file is None:
+        return hist_trans_df, merch_trans_df, None
+
+    return (rename_transaction_columns(hist_trans_df),
+            rename_transaction_columns(merch_trans_df),
+            merchant_lookup_table(load_processed(merchants_file)))
+
+
+@instrumented()
+def transaction_features(cards_index, hist_trans_file, merch_trans_file,
+                         n_workers=1, cache_dir=None, merchants_file=None, features=None):
+    '''Returns a data frame with the transaction features (see
+    `add_transaction_features`) of the given cards, loading the transactions
+    (and merchants, see `load_transaction_data`) from the given files. If the
+    names of the `features` are given, only those are computed.
+
+    If `cache_dir` is given, the features are kept in a per-card cache there,
+    keyed on the contents of the transactions files and the `feature_spec`.
+    Only the cards that aren't in the cache yet are computed (if there are
+    none, the transactions aren't even loaded), and then added to it.
+    '''
+    cached = None
+    if cache_dir:
+        input_files = [hist_trans_file, merch_trans_file]
+        if merchants_file is not None:
+            input_files.append(merchants_file)
+        key = cache_key(input_files, feature_spec(features))
+        cached = read_cached_features(cache_dir, key)
+
+    if cached is None:
+        missing = cards_index
+    else:
+        missing = cards_index.difference(cached.index)
+        print(f'Found {len(cards_index) - len(missing)} of {len(cards_index)} '
+              'cards in the feature cache ...')
+    if len(missing) == 0:
+        return cached.loc[cards_index]
+
+    hist_trans_df, merch_trans_df, merchants_df = load_transaction_data(
+        hist_trans_file, merch_trans_file, merchants_file)
+
+    features_df = pd.DataFrame(index=missing)
+    if n_workers > 1:
+        features_df = process_data_in_parallel(features_df, hist_trans_df,
+                                               merch_trans_df, n_workers,
+                                               process=add_transaction_features,
+                                               merchants_df=merchants_df,
+                                               features=features)
+    else:
+        features_df = add_transaction_features(features_df, hist_trans_df, merch_trans_df,
+                                               merchants_df=merchants_df,
+                                               features=features)
+
+    if cached is not None:
+        features_df = pd.concat([cached, features_df])
+        for col in features_df.columns:
+            if col.endswith('_top'):
+                features_df[col] = features_df[col].astype('category').cat.as_ordered()
+    if cache_dir:
+        write_cached_features(cache_dir, key, features_df)
+
+    return features_df.loc[cards_index]
+
+
+def matrix_dirname(matrix_dir, outfile):
+    '''Returns the directory in `matrix_dir` that the feature matrix (see
+    `feature_matrix.write_feature_matrix`) of the given output file goes to,
+    e.g. 'data/processed/matrices/train_with_aggregated_features'.'''
+    return os.path.join(matrix_dir, os.path.splitext(os.path.basename(outfile))[0])
+
+
+def unknown_features(features):
+    '''Returns those of the given feature names that are neither columns of
+    the cards csvs, nor date parts of `first_active_month`, nor features of
+    `table_features`, which are probably typos. (Whether the value of a ratio
+    feature occurs in the transactions isn't checked.)'''
+    known = set(card_feature_names + [target_column])
+    ratio_prefixes = []
+    for spec in table_features.values():
+        known.update(aggregated_feature_names(spec['aggregators'],
+                                              top_columns=spec['top_columns'],
+                                              prefix=spec['prefix']))
+        ratio_prefixes += [f"{spec['prefix']}{col}_" for col in spec['ratio_columns']]
+    return [name for name in features
+            if name not in known and not name.startswith('first_active_month') and
+            not (name.endswith('_ratio') and name.startswith(tuple(ratio_prefixes)))]
+
+
+def feature_names_argument(value):
+    '''Returns the list of feature names given on the command line: either
+    comma separated, or '@' followed by the name of a file with one name per
+    line.'''
+    if value.startswith('@'):
+        with open(value[1:]) as f:
+            return [line.strip() for line in f if line.strip()]
+    return [name for name in value.split(',') if name]
 
 
 if __name__ == "__main__":
@@ -213,24 +475,82 @@ if __name__ == "__main__":
     parser.add_argument('train_df', type=str,
                         help='Filename of the train (or test) csv.')
     parser.add_argument('hist_trans_df', type=str,
-                        help='Filename of the historical transactions csv.')
+                        help='Filename of the historical transactions (joined with merchants, '
+                             'unless --merchants is given).')
     parser.add_argument('merch_trans_df', type=str,
-                        help='Filename of the new merchant transactions csv.')
+                        help='Filename of the new merchant transactions (joined with merchants, '
+                             'unless --merchants is given).')
     parser.add_argument('outfile', type=str,
-                        help='Filename of the result csv.')
+                        help='Filename of the result (.csv, .parquet or .feather).')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of processes to compute the features in.')
+    parser.add_argument('--also', nargs=2, action='append',
+                        metavar=('CARDS_CSV', 'OUTFILE'),
+                        help='Another csv of cards (e.g. the test csv) to compute the features '
+                             'for, in the same run, and the filename of its result.')
+    parser.add_argument('--cache_dir', type=str, default=None,
+                        help='Directory of a per-card cache of the transaction features, '
+                             'so that unchanged cards aren\'t recomputed.')
+    parser.add_argument('--merchants', type=str, default=None,
+                        help='Filename of the cleaned merchants. If given, the transactions aren\'t '
+                             'joined with them, and the merchant columns are looked up by merchant id '
+                             'when aggregating instead.')
+    parser.add_argument('--matrix_dir', type=str, default=None,
+                        help='If given, also write the features of every output as a memory mappable '
+                             'matrix to a directory (named after the output file) in this directory. '
+                             'The categorical features of all outputs are encoded with the categories '
+                             'of the first one.')
+    parser.add_argument('--features', type=feature_names_argument, default=None,
+                        help='Comma separated names of the features to compute (e.g. '
+                             'purchase_amount_mean,merch_category_3_A_ratio,city_id_top), instead of '
+                             'all of them. Only the aggregations these need are computed. Use @FILE to '
+                             'read the names from a file with one name per line instead.')
+    add_instrumentation_arguments(parser)
     args = vars(parser.parse_args())
+    configure_from_args(args)
+    if args['features'] and unknown_features(args['features']):
+        parser.error(f"unknown features: {', '.join(unknown_features(args['features']))}")
 
-    print(f"Loading data frame from {args['train_df']} ...")
-    train_df = pd.read_csv(args['train_df'],
-                           index_col='card_id',
-                           parse_dates=['first_active_month'])
+    outputs = [(args['train_df'], args['outfile'])] + (args['also'] or [])
+    categories = None
 
-    print(f"Loading data frame from {args['hist_trans_df']} ...")
-    hist_trans_df = pd.read_csv(args['hist_trans_df'])
+    if args['cache_dir'] or len(outputs) > 1:
+        # Compute the transaction features once for the cards of all outputs
+        # (or get them from the cache) and then join them to each of them.
+        cards_dfs = [load_cards(cards_file) for cards_file, _ in outputs]
+        all_cards = cards_dfs[0].index.append(
+            [cards_df.index for cards_df in cards_dfs[1:]]).unique()
+        features = transaction_features(all_cards,
+                                        args['hist_trans_df'],
+                                        args['merch_trans_df'],
+                                        n_workers=args['workers'],
+                                        cache_dir=args['cache_dir'],
+                                        merchants_file=args['merchants'],
+                                        features=args['features'])
+        for cards_df, (_, outfile) in zip(cards_dfs, outputs):
+            add_first_active_month_features(cards_df, features=args['features'])
+            result_df = cards_df.join(features)
+            write_frame(result_df, outfile)
+            if args['matrix_dir']:
+                categories = write_feature_matrix(result_df,
+                                                  matrix_dirname(args['matrix_dir'], outfile),
+                                                  categories)
+    else:
+        train_df = load_cards(args['train_df'])
 
-    print(f"Loading data frame from {args['merch_trans_df']} ...")
-    merch_trans_df = pd.read_csv(args['merch_trans_df'])
+        hist_trans_df, merch_trans_df, merchants_df = load_transaction_data(
+            args['hist_trans_df'], args['merch_trans_df'], args['merchants'])
 
-    process_data(train_df, hist_trans_df, merch_trans_df)
+        if args['workers'] > 1:
+            train_df = process_data_in_parallel(train_df, hist_trans_df,
+                                                merch_trans_df, args['workers'],
+                                                merchants_df=merchants_df,
+                                                features=args['features'])
+        else:
+            train_df = process_data(train_df, hist_trans_df, merch_trans_df,
+                                    merchants_df=merchants_df,
+                                    features=args['features'])
 
-    train_df.to_csv(args['outfile'])
+        write_frame(train_df, args['outfile'])
+        if args['matrix_dir']:
+            write_feature_matrix(train_df, matrix_dirname(args['matrix_dir'], args['outfile']))
@@ -0,0 +1,178 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from instrumentation import instrumented
+
+
+# Besides the csvs, `feature_engineering.py` can write the features as a matrix
+# that training code can memory map (see `load_feature_matrix`) instead of
+# parsing the csvs and encoding the categorical columns again every time:
+#
+# - continuous.npy: a float32 matrix of the continuous features (nan for
+#   missing values), one row per card,
+# - categorical.npy: a matrix of integer codes of the categorical features,
+#   where 0 stands for a missing (or unknown) value and `i` for the `i`th
+#   category, the way fastai's `Categorify` encodes them,
+# - target.npy: the float32 target, if there is one,
+# - card_id.npy: the card id of every row, and
+# - meta.json: the names of the columns of both matrices, the categories of
+#   every categorical feature and the number of rows.
+
+# The columns of the cards csvs that aren't features.
+target_column = 'target'
+
+# The date parts of `first_active_month` that are categorical, the elapsed time
+# is continuous (see `feature_engineering.add_first_active_month_features`).
+categorical_date_parts = ['first_active_monthYear',
+                          'first_active_monthMonth',
+                          'first_active_monthWeek',
+                          'first_active_monthIs_quarter_start',
+                          'first_active_monthIs_year_start']
+
+# The anonymized features of the cards.
+card_feature_names = ['feature_1', 'feature_2', 'feature_3']
+
+
+def is_categorical_feature(name):
+    '''Returns whether the feature with the given name is categorical, i.e. one
+    of the card features, categorical date parts or top values.'''
+    return (name in card_feature_names or name in categorical_date_parts or
+            name.endswith('_top'))
+
+
+def feature_names(columns):
+    '''Returns the names of the categorical and the continuous features among
+    the given columns of a cards data frame.'''
+    features = [col for col in columns if col != target_column]
+    categorical_names = [col for col in features if is_categorical_feature(col)]
+    continuous_names = [col for col in features if col not in categorical_names]
+    return categorical_names, continuous_names
+
+
+def feature_categories(values):
+    '''Returns the categories of the given series of feature values, in the
+    order that `astype('category')` (and so fastai's `Categorify`) gives
+    them.
+
+    Categories that don't occur are left out, e.g. those of the top values of
+    the test cards when the features of the train and test cards were
+    aggregated together.'''
+    if values.dtype.name != 'category':
+        values = values.astype('category')
+    return values.cat.remove_unused_categories().cat.categories
+
+
+def category_codes(values, categories):
+    '''Returns the codes of the given series of values for the given categories,
+    with 1 for the first category and 0 for missing values and values that
+    aren't one of the categories.'''
+    return pd.Index(categories).get_indexer(values) + 1
+
+
+def code_dtype(n_codes):
+    '''Returns the smallest signed integer type for codes in `[0, n_codes)`.'''
+    for dtype in [np.int8, np.int16, np.int32]:
+        if n_codes <= np.iinfo(dtype).max + 1:
+            return dtype
+    return np.int64
+
+
+@instrumented()
+def write_feature_matrix(df, matrix_dir, categories=None):
+    '''Writes the given data frame of features (indexed by card id) to the given
+    directory as a memory mappable matrix (see the top of this file).
+
+    The categories of the categorical features are taken from `categories` (a
+    map of the feature names to lists of their categories) if given, e.g. to
+    encode the test features the same way as the training features, and
+    otherwise from the data. Returns the categories used.
+    '''
+    os.makedirs(matrix_dir, exist_ok=True)
+    categorical_names, continuous_names = feature_names(df.columns)
+
+    if categories is None:
+        categories = {col: feature_categories(df[col]).tolist() for col in categorical_names}
+    n_codes = max([len(values) + 1 for values in categories.values()], default=1)
+
+    # Write the matrices column by column, so we never need more than one
+    # converted column in memory besides the data frame.
+    continuous = np.lib.format.open_memmap(os.path.join(matrix_dir, 'continuous.npy'), mode='w+',
+                                           dtype=np.float32, shape=(len(df), len(continuous_names)))
+    for i, col in enumerate(continuous_names):
+        continuous[:, i] = df[col].astype(np.float32).values
+    continuous.flush()
+    del continuous
+
+    categorical = np.lib.format.open_memmap(os.path.join(matrix_dir, 'categorical.npy'), mode='w+',
+                                            dtype=code_dtype(n_codes),
+                                            shape=(len(df), len(categorical_names)))
+    for i, col in enumerate(categorical_names):
+        categorical[:, i] = category_codes(df[col], categories[col])
+    categorical.flush()
+    del categorical
+
+    if target_column in df.columns:
+        np.save(os.path.join(matrix_dir, 'target.npy'), df[target_column].values.astype(np.float32))
+    np.save(os.path.join(matrix_dir, 'card_id.npy'), np.asarray(df.index, dtype=str))
+
+    meta = {'rows': len(df),
+            'continuous_names': continuous_names,
+            'categorical_names': categorical_names,
+            'categories': {col: categories[col] for col in categorical_names},
+            'target': target_column if target_column in df.columns else None}
+    with open(os.path.join(matrix_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f, default=str)
+
+    return categories
+
+
+def load_feature_matrix(matrix_dir):
+    '''Opens the feature matrix written by `write_feature_matrix` to the given
+    directory. Returns a map with the memory mapped (read only) arrays
+    'continuous', 'categorical', 'target' (None if there isn't one) and
+    'card_id', and the 'meta' data.
+
+    Nothing is read until it's used, and processes that map the same files
+    share their pages.
+    '''
+    def load(name):
+        filename = os.path.join(matrix_dir, f'{name}.npy')
+        return np.load(filename, mmap_mode='r') if os.path.exists(filename) else None
+
+    with open(os.path.join(matrix_dir, 'meta.json')) as f:
+        meta = json.load(f)
+
+    return {'continuous': load('continuous'),
+            'categorical': load('categorical'),
+            'target': load('target'),
+            'card_id': load('card_id'),
+            'meta': meta}
+
+
+def load_feature_frame(matrix_dir, rows=slice(None)):
+    '''Loads the feature matrix written by `write_feature_matrix` to the given
+    directory as a data frame like the one it was written from: indexed by card
+    id, with the categorical features as categoricals (with the categories of
+    the matrix) and the continuous ones as float32.
+
+    Only the given rows (a slice) are read, e.g. `slice(0, 100000)` for the
+    first 100000 cards.
+    '''
+    matrix = load_feature_matrix(matrix_dir)
+    meta = matrix['meta']
+
+    columns = {}
+    categorical = matrix['categorical'][rows]
+    for i, col in enumerate(meta['categorical_names']):
+        codes = categorical[:, i].astype(np.int64) - 1
+        columns[col] = pd.Categorical.from_codes(codes, categories=meta['categories'][col])
+    continuous = matrix['continuous'][rows]
+    for i, col in enumerate(meta['continuous_names']):
+        columns[col] = np.array(continuous[:, i])
+    if matrix['target'] is not None:
+        columns[meta['target']] = np.array(matrix['target'][rows])
+
+    return pd.DataFrame(columns, index=pd.Index(matrix['card_id'][rows], name='card_id'))
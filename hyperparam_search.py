@@ -0,0 +1,533 @@
+import json
+import os
+import time
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+import torch
+from fastai.basic_data import DataBunch
+from fastai.callback import Callback
+from fastai.data_block import FloatList
+from fastai.layers import MSELossFlat
+from fastai.metrics import rmse
+from fastai.tabular import Categorify, FillMissing, Normalize, TabularList, tabular_learner
+from fastai.tabular.data import def_emb_sz
+from fastai.torch_core import defaults
+from hyperopt import JOB_STATE_DONE, STATUS_FAIL, STATUS_OK, Trials, hp, space_eval, tpe
+from hyperopt.base import Domain
+from sklearn.model_selection import train_test_split
+
+from feature_matrix import load_feature_matrix, target_column
+from instrumentation import (add_instrumentation_arguments, configure, configure_from_args,
+                             current_settings, instrumented)
+from model_features import category_names, continuous_names
+
+
+# The hyperparameter search of `elo_loyalty_prediction.ipynb` as a script, which
+# trains the models of several trials at once in a pool of worker processes,
+# instead of one after the other.
+#
+# Every finished trial is appended to a json lines file right away (see
+# `append_trial`), so a search that's interrupted can be resumed by running it
+# again with the same file, and `load_trials` gets the trials as hyperopt
+# `Trials` for the plots in the notebook.
+#
+# The features can also come from a feature matrix (see `feature_matrix.py`),
+# in which case the workers don't load them at all: they train on the memory
+# mapped matrix itself (see `MatrixDataset`), so they all share one copy of it,
+# and encode its rows the way fastai's procs would have (see
+# `matrix_encoding`), which is worked out once before the workers start.
+
+# The search space of the notebook.
+space = {
+    'num_layers': hp.quniform('num_layers', 1, 6, 1),
+    'layer_size': hp.quniform('layer_size', 25, 5000, 25),
+    'layer_dropout': hp.loguniform('layer_dropout', np.log(1e-10), np.log(5e-1)),
+    'emb_drop': hp.uniform('emb_drop', 1e-4, 5e-1),
+    'wd': hp.uniform('wd', 0.1, 0.9),
+    'lr': hp.loguniform('learning_rate', np.log(1e-5), np.log(1e-2)),
+}
+
+# The validation set of the notebook.
+validation_size = 0.2
+validation_seed = 238923
+
+
+def get_layers(params):
+    '''Given a hyperparameter dictionary, return a pair of lists, one containing
+    the layer sizes and one the dropouts for each layer.'''
+    layer_range = range(0, int(params['num_layers']))
+    layers = [round(params['layer_size'] / pow(2, i)) for i in layer_range]
+    ps = [params['layer_dropout'] / pow(10, i) for i in layer_range][::-1]
+    return layers, ps
+
+
+def split_rows(n_rows):
+    '''Returns the row numbers of the training and the validation set of the
+    notebook for the given number of cards.'''
+    return train_test_split(np.arange(n_rows), test_size=validation_size,
+                            random_state=validation_seed)
+
+
+@instrumented()
+def load_features(filename):
+    '''Loads the features of the training cards from the given csv written by
+    `feature_engineering.py`. Returns a data frame of the features of the model
+    (see `model_features.py`) and the target.'''
+    df = pd.read_csv(filename, index_col='card_id')
+    missing = [col for col in category_names + continuous_names if col not in df.columns]
+    if missing:
+        raise ValueError(f'{filename} lacks the model features {", ".join(missing)}.')
+    return df[category_names + continuous_names + [target_column]]
+
+
+@instrumented()
+def training_data(train_and_validation_df, path='learner'):
+    '''Splits the given features into the training and validation set of the
+    notebook and returns them as a fastai data bunch of the features of the
+    model (see `model_features.py`), along with the range of the targets for
+    the model.'''
+    train_rows, valid_rows = split_rows(len(train_and_validation_df))
+    train_df = train_and_validation_df.iloc[train_rows]
+    validate_df = train_and_validation_df.iloc[valid_rows]
+    df = pd.concat([train_df, validate_df]).reset_index()[category_names + continuous_names +
+                                                           [target_column]]
+    valid_idx = range(len(train_df), len(df))
+    # Copies, since `FillMissing` adds the `_na` columns to the list it's given.
+    data = (TabularList.from_df(df,
+                                path=path,
+                                cat_names=list(category_names),
+                                cont_names=list(continuous_names),
+                                procs=[FillMissing, Categorify, Normalize])
+                    .split_by_idx(valid_idx)
+                    .label_from_df(cols=target_column, label_cls=FloatList)
+                    .databunch())
+
+    min_y = np.min(train_df[target_column]) * 1.2
+    max_y = np.max(train_df[target_column]) * 1.2
+    y_range = torch.tensor([min_y, max_y], device=defaults.device)
+    return data, y_range
+
+
+@instrumented()
+def matrix_encoding(matrix_dir):
+    '''Works out how to encode the rows of the given feature matrix (see
+    `feature_matrix.py`) of the training cards for the model the way the procs
+    of `training_data` encode the features from the csv, from the cards of the
+    training set of the notebook:
+
+    - `Categorify`: the codes of the categories that occur in the training set,
+      in order, with 0 for the others (and missing values).
+    - `FillMissing`: continuous features with missing values in the training
+      set get another categorical `_na` feature telling whether the value was
+      missing, and missing values are filled with the median of the training
+      set. We fill missing values in the other continuous features with the
+      median, too, where fastai would refuse to go on.
+    - `Normalize`: the continuous features are normalized with the mean and
+      standard deviation of the training set (after filling in the missing
+      values).
+
+    Returns a map of everything `MatrixDataset` needs for that, including the
+    rows of the training and validation set and the range of the targets for
+    the model. It's small, so it can be handed to the workers of `search`.
+    '''
+    matrix = load_feature_matrix(matrix_dir)
+    meta = matrix['meta']
+    missing = ([col for col in category_names if col not in meta['categorical_names']] +
+               [col for col in continuous_names if col not in meta['continuous_names']])
+    if missing:
+        raise ValueError(f'{matrix_dir} lacks the model features {", ".join(missing)}.')
+    if matrix['target'] is None:
+        raise ValueError(f'{matrix_dir} has no {target_column}.')
+
+    # The rows are read in the order of the file, which is much faster than in
+    # the shuffled order of the split.
+    train_rows, valid_rows = [np.sort(rows) for rows in split_rows(meta['rows'])]
+
+    classes = OrderedDict()
+    code_maps = []
+    categorical_columns = [meta['categorical_names'].index(col) for col in category_names]
+    for col, i in zip(category_names, categorical_columns):
+        present = np.zeros(len(meta['categories'][col]) + 1, dtype=bool)
+        present[np.unique(matrix['categorical'][:, i][train_rows])] = True
+        present[0] = False
+        code_maps.append(np.where(present, np.cumsum(present), 0))
+        classes[col] = ['#na#'] + [value for value, is_present
+                                   in zip(meta['categories'][col], present[1:]) if is_present]
+
+    fills, means, stds, na_columns, na_maps = [], [], [], [], []
+    continuous_columns = [meta['continuous_names'].index(col) for col in continuous_names]
+    for j, (col, i) in enumerate(zip(continuous_names, continuous_columns)):
+        values = pd.Series(matrix['continuous'][:, i][train_rows].astype(np.float64))
+        fills.append(values.median())
+        is_missing = values.isnull()
+        if is_missing.any():
+            # The codes of False and True in the `_na` feature.
+            seen = sorted(is_missing.unique())
+            na_columns.append(j)
+            na_maps.append([seen.index(value) + 1 if value in seen else 0
+                            for value in [False, True]])
+            classes[f'{col}_na'] = ['#na#'] + seen
+            values = values.fillna(fills[-1])
+        means.append(values.mean())
+        stds.append(values.std())
+
+    target = matrix['target'][train_rows]
+    return {'train_rows': train_rows,
+            'valid_rows': valid_rows,
+            'classes': classes,
+            'categorical_columns': categorical_columns,
+            'code_offsets': np.cumsum([0] + [len(m) for m in code_maps[:-1]]),
+            'code_map': np.concatenate(code_maps),
+            'continuous_columns': continuous_columns,
+            'na_columns': na_columns,
+            'na_maps': np.array(na_maps, dtype=np.int64).reshape(-1, 2),
+            'fills': np.array(fills),
+            'means': np.array(means),
+            'stds': np.array(stds),
+            'y_range': [float(np.min(target)) * 1.2, float(np.max(target)) * 1.2]}
+
+
+class MatrixDataset(torch.utils.data.Dataset):
+    '''The given rows of a feature matrix (see `load_feature_matrix`) as a
+    dataset for fastai's tabular model, encoded with the given
+    `matrix_encoding`. Every row is read from the memory mapped matrix when
+    it's used, so processes training on the same matrix share it.
+
+    It also has what `tabular_learner` needs to know about the data.
+    '''
+
+    def __init__(self, matrix, encoding, rows):
+        self.matrix = matrix
+        self.encoding = encoding
+        self.rows = rows
+        self.cat_names = list(encoding['classes'])
+        self.cont_names = list(continuous_names)
+        self.c = 1
+
+    def __len__(self):
+        return len(self.rows)
+
+    def get_emb_szs(self, sz_dict=None):
+        return [def_emb_sz(self.encoding['classes'], name, sz_dict) for name in self.cat_names]
+
+    def __getitem__(self, i):
+        row, encoding = self.rows[i], self.encoding
+        codes = self.matrix['categorical'][row, encoding['categorical_columns']]
+        conts = self.matrix['continuous'][row, encoding['continuous_columns']].astype(np.float64)
+        is_missing = np.isnan(conts)
+        na_codes = encoding['na_maps'][np.arange(len(encoding['na_columns'])),
+                                       is_missing[encoding['na_columns']].astype(np.int64)]
+        cats = np.concatenate([encoding['code_map'][encoding['code_offsets'] + codes], na_codes])
+        conts = np.where(is_missing, encoding['fills'], conts)
+        conts = (conts - encoding['means']) / (1e-7 + encoding['stds'])
+        return ([torch.from_numpy(cats.astype(np.int64)), torch.from_numpy(conts.astype(np.float32))],
+                torch.tensor(self.matrix['target'][row]))
+
+
+@instrumented()
+def matrix_training_data(matrix_dir, encoding, path='learner'):
+    '''Like `training_data`, but for the feature matrix in the given directory,
+    encoded with the given `matrix_encoding` of it.'''
+    matrix = load_feature_matrix(matrix_dir)
+    data = DataBunch.create(MatrixDataset(matrix, encoding, encoding['train_rows']),
+                            MatrixDataset(matrix, encoding, encoding['valid_rows']),
+                            path=path)
+    y_range = torch.tensor(encoding['y_range'], device=defaults.device)
+    return data, y_range
+
+
+class PruningCallback(Callback):
+    '''Stops training a trial after an epoch if its best validation loss so far
+    is worse than `thresholds[epoch]` (see `pruning_thresholds`), but not
+    before `min_epochs` epochs, or if the loss diverged.'''
+
+    def __init__(self, thresholds, min_epochs):
+        self.thresholds = thresholds
+        self.min_epochs = min_epochs
+        self.best = np.inf
+        self.pruned = False
+
+    def on_epoch_end(self, epoch, last_metrics, **kwargs):
+        val_loss = float(last_metrics[0])
+        self.best = min(self.best, val_loss)
+        threshold = self.thresholds[epoch] if epoch < len(self.thresholds) else None
+        if (not np.isfinite(val_loss) or
+                (epoch + 1 >= self.min_epochs and threshold is not None and self.best > threshold)):
+            self.pruned = True
+            return {'stop_training': True}
+
+
+def objective(params, data, y_range, epochs=5, thresholds=(), min_epochs=2):
+    '''Given a set of parameters, train the model for some epochs and return
+    the lowest validation error found during those runs.
+
+    The training is stopped early if the trial is pruned (see
+    `PruningCallback`), in which case its lowest validation error so far is
+    returned.'''
+    layers, ps = get_layers(params)
+    learn = tabular_learner(data,
+                            layers=layers,
+                            ps=ps,
+                            emb_drop=params['emb_drop'],
+                            y_range=y_range,
+                            metrics=rmse,
+                            loss_func=MSELossFlat())
+
+    pruning = PruningCallback(thresholds, min_epochs)
+    learn.fit_one_cycle(epochs, params['lr'], wd=params['wd'], callbacks=[pruning])
+
+    val_losses = [float(loss) for loss in learn.recorder.val_losses]
+    print(f'Got losses: {val_losses} for params {params}')
+
+    # Extract the best score, if the training didn't diverge right away.
+    finite = [loss for loss in val_losses if np.isfinite(loss)]
+    return {'loss': min(finite) if finite else None,
+            'val_losses': val_losses,
+            'pruned': pruning.pruned,
+            'status': STATUS_OK if finite else STATUS_FAIL}
+
+
+def pruning_thresholds(records, min_trials):
+    '''Returns the median stopping rule for the given finished trials: the
+    median of the best validation losses up to every epoch of the trials that
+    got that far, or None for epochs that fewer than `min_trials` trials got
+    to.'''
+    curves = [np.fmin.accumulate(record['val_losses']) for record in records
+              if record['status'] == STATUS_OK and record['val_losses']]
+    thresholds = []
+    for epoch in range(max([len(curve) for curve in curves], default=0)):
+        best = [curve[epoch] for curve in curves if len(curve) > epoch]
+        thresholds.append(float(np.nanmedian(best)) if len(best) >= min_trials else None)
+    return thresholds
+
+
+# The data that the worker processes of `search` train on, loaded once per
+# worker by `_init_worker`.
+_training = {}
+
+
+def _init_worker(features_file, encoding, threads, instrumentation_settings):
+    '''Loads the training data in a worker process of `search`, from the
+    feature matrix with the given `matrix_encoding` if there is one.'''
+    configure(**instrumentation_settings)
+    torch.set_num_threads(threads)
+    if encoding is not None:
+        _training['data'], _training['y_range'] = matrix_training_data(features_file, encoding)
+    else:
+        _training['data'], _training['y_range'] = training_data(load_features(features_file))
+
+
+def _run_trial(params, epochs, thresholds, min_epochs):
+    '''Runs the `objective` on the data of this worker process and adds the
+    time and process it took to the result.'''
+    start = time.time()
+    result = objective(params, _training['data'], _training['y_range'], epochs=epochs,
+                       thresholds=thresholds, min_epochs=min_epochs)
+    result.update(seconds=round(time.time() - start, 1), pid=os.getpid())
+    return result
+
+
+def read_trials(trials_file):
+    '''Returns the records of the trials appended to the given file (see
+    `append_trial`), or an empty list if there is no such file.
+
+    A last line that isn't complete json, which is what an interrupted write
+    leaves behind, is ignored.'''
+    if not os.path.exists(trials_file):
+        return []
+    records = []
+    with open(trials_file) as f:
+        lines = f.read().splitlines()
+    for i, line in enumerate(lines):
+        try:
+            records.append(json.loads(line))
+        except json.JSONDecodeError:
+            if i < len(lines) - 1:
+                raise
+    return records
+
+
+def append_trial(trials_file, record):
+    '''Appends the given trial record as a line of json to the given file.'''
+    with open(trials_file, 'a') as f:
+        f.write(json.dumps(record, default=lambda value: value.item()) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def trial_result(record):
+    '''Returns the hyperopt result of the given trial record.'''
+    if record['status'] == STATUS_OK:
+        return {'status': STATUS_OK, 'loss': record['loss'], 'params': record['params']}
+    return {'status': STATUS_FAIL}
+
+
+def trial_doc(trials, domain, record):
+    '''Returns a hyperopt trial document (done, with its result) of the given
+    trial record.'''
+    tid = record['tid']
+    misc = {'tid': tid,
+            'cmd': domain.cmd,
+            'workdir': domain.workdir,
+            'idxs': {label: [tid] if vals else [] for label, vals in record['vals'].items()},
+            'vals': record['vals']}
+    [doc] = trials.new_trial_docs([tid], [None], [trial_result(record)], [misc])
+    doc['state'] = JOB_STATE_DONE
+    return doc
+
+
+def search_domain():
+    '''Returns the hyperopt domain of the search space.'''
+    return Domain(objective, space)
+
+
+def load_trials(trials_file):
+    '''Returns the trials of the given file as hyperopt `Trials`, e.g. for
+    `hyperopt.plotting`.'''
+    trials, domain = Trials(), search_domain()
+    trials.insert_trial_docs([trial_doc(trials, domain, record)
+                              for record in read_trials(trials_file)])
+    trials.refresh()
+    return trials
+
+
+def suggest(trials, domain, tid, seed):
+    '''Suggests the parameters of the trial with the given id with TPE, given
+    the finished trials. The new trial is added to `trials` (as pending, which
+    TPE ignores). Returns the values of the labels of the space and the
+    parameters.'''
+    [doc] = tpe.suggest([tid], domain, trials, seed)
+    trials.insert_trial_docs([doc])
+    trials.refresh()
+    vals = {label: [value.item() if isinstance(value, np.generic) else value for value in values]
+            for label, values in doc['misc']['vals'].items()}
+    params = space_eval(space, {label: values[0] for label, values in vals.items() if values})
+    return vals, params
+
+
+def finish_trial(trials, record):
+    '''Sets the result of the pending trial of the given record in `trials`.'''
+    # This is what `hyperopt.fmin` does with the trials it evaluates.
+    for doc in trials._dynamic_trials:
+        if doc['tid'] == record['tid']:
+            doc['result'] = trial_result(record)
+            doc['state'] = JOB_STATE_DONE
+    trials.refresh()
+
+
+def best_trial(records):
+    '''Returns the record of the finished trial with the lowest loss.'''
+    return min([record for record in records if record['status'] == STATUS_OK],
+               key=lambda record: record['loss'])
+
+
+def search(features_file, trials_file, max_evals=25, n_workers=1, threads=None, epochs=5,
+           min_epochs=2, min_trials=5, seed=0):
+    '''Runs a TPE search over `space` until `max_evals` trials (including those
+    already in `trials_file`) are done, training the models of `n_workers`
+    trials at once in worker processes with `threads` threads each. Every
+    finished trial is appended to `trials_file`. Returns the records of all
+    trials.
+
+    After `min_epochs` epochs, a trial that is worse than the median of the
+    finished trials (see `pruning_thresholds`) is stopped to make room for the
+    next one.
+    '''
+    import multiprocessing
+    from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+    threads = threads or max(1, (os.cpu_count() or 1) // n_workers)
+    records = read_trials(trials_file)
+    if records:
+        print(f'Resuming the search with {len(records)} trials from {trials_file} ...')
+
+    trials, domain = Trials(), search_domain()
+    trials.insert_trial_docs([trial_doc(trials, domain, record) for record in records])
+    trials.refresh()
+    next_tid = max([record['tid'] for record in records], default=-1) + 1
+
+    encoding = matrix_encoding(features_file) if os.path.isdir(features_file) else None
+
+    # Torch's thread pools don't survive a fork, so the workers are started
+    # fresh and load the data themselves.
+    pool = ProcessPoolExecutor(n_workers,
+                               mp_context=multiprocessing.get_context('spawn'),
+                               initializer=_init_worker,
+                               initargs=(features_file, encoding, threads, current_settings()))
+    pending = {}
+    try:
+        while len(records) + len(pending) < max_evals or pending:
+            # Keep every worker busy.
+            while len(records) + len(pending) < max_evals and len(pending) < n_workers:
+                tid = next_tid
+                next_tid += 1
+                vals, params = suggest(trials, domain, tid, seed + tid)
+                future = pool.submit(_run_trial, params, epochs,
+                                     pruning_thresholds(records, min_trials), min_epochs)
+                pending[future] = {'tid': tid, 'vals': vals, 'params': params}
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                record = pending.pop(future)
+                try:
+                    record.update(future.result())
+                except Exception as e:
+                    print(f'Trial {record["tid"]} failed: {e!r}')
+                    record.update(status=STATUS_FAIL, loss=None, val_losses=[], error=repr(e))
+                append_trial(trials_file, record)
+                records.append(record)
+                finish_trial(trials, record)
+                print(f'Trial {record["tid"]} ({len(records)}/{max_evals}): loss {record["loss"]}'
+                      f'{" (pruned)" if record.get("pruned") else ""}')
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    return records
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Searches for the hyperparameters of the tabular model in several processes.')
+    parser.add_argument('features', type=str,
+                        help='Features of the training cards, either the csv written by '
+                             'feature_engineering.py or the directory of its feature matrix '
+                             '(see --matrix_dir).')
+    parser.add_argument('trials_file', type=str,
+                        help='File to append the trials to as json lines. If it exists, the '
+                             'search is resumed from the trials in it.')
+    parser.add_argument('--max_evals', type=int, default=25,
+                        help='Total number of trials, including those already in trials_file.')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of trials to train at the same time.')
+    parser.add_argument('--threads', type=int, default=None,
+                        help='Number of torch threads per worker. Defaults to the number of CPUs '
+                             'divided by the number of workers.')
+    parser.add_argument('--epochs', type=int, default=5,
+                        help='Number of epochs to train every trial for.')
+    parser.add_argument('--min_epochs', type=int, default=2,
+                        help='Number of epochs before a trial can be stopped for being worse than '
+                             'the median of the finished ones.')
+    parser.add_argument('--min_trials', type=int, default=5,
+                        help='Number of finished trials needed before any trial is stopped early.')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed for the suggestions of TPE.')
+    add_instrumentation_arguments(parser)
+    args = vars(parser.parse_args())
+    configure_from_args(args)
+
+    records = search(args['features'], args['trials_file'],
+                     max_evals=args['max_evals'],
+                     n_workers=args['workers'],
+                     threads=args['threads'],
+                     epochs=args['epochs'],
+                     min_epochs=args['min_epochs'],
+                     min_trials=args['min_trials'],
+                     seed=args['seed'])
+
+    best = best_trial(records)
+    print(f'Best loss {best["loss"]} in trial {best["tid"]} with params {best["params"]}')
+    print(f'Layers and dropouts: {get_layers(best["params"])}')
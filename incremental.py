@@ -0,0 +1,543 @@
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from aggregation import get_ratio_values, lookup_columns
+from clean_transactions import delta_files, elapsed_since_last_in_group, prepare_transactions
+from feature_engineering import matrix_dirname, table_features
+from feature_matrix import write_feature_matrix
+from instrumentation import add_instrumentation_arguments, configure_from_args, instrumented
+from join_transactions_and_merchants import merchant_lookup_table, rename_transaction_columns
+from loaders import load_processed, load_transactions
+from storage import read_frame, write_frame
+
+
+# Instead of recomputing the features of all cards whenever new transactions
+# come in, we can keep a per-card state of the aggregations that can be merged
+# with the same state for the new transactions only:
+#
+# - for the numerical aggregations the count, sum, mean, sum of squared
+#   differences from the mean (to get the std, see `merge_numerical`), min and
+#   max of every column,
+# - for `nunique` the distinct (card, value) pairs,
+# - for the ratio and top columns the counts of every (card, value) pair, and
+# - the last `purchase_Elapsed` of every card (and card and merchant), to get
+#   the times since the last purchases of the new transactions.
+#
+# The features are then computed from the state of a card alone, so only the
+# cards with new transactions need to be updated. There's one state for each of
+# the two transactions tables, the historical one (which gets the
+# `hist_trans_aggs`, too) and the new merchant one (whose features have the
+# prefix 'merch_').
+
+# The aggregator functions computed from the numerical state.
+numerical_aggregators = ['sum', 'mean', 'min', 'max', 'std']
+
+numerical_stats = ['count', 'sum', 'mean', 'm2', 'min', 'max']
+
+
+def table_spec(table):
+    '''Returns the aggregators, ratio columns, top columns and feature prefix of
+    the given table, 'historical' or 'new' (see
+    `feature_engineering.table_features`).'''
+    if table == 'historical':
+        return dict(table_features['historical'])
+    elif table == 'new':
+        return dict(table_features['new_merchant'])
+    raise ValueError(f'Unknown transactions table {table}, should be historical or new.')
+
+
+def spec_columns(spec):
+    '''Returns the numerical, nunique and counted (ratio and top) columns of the
+    given table spec.'''
+    numerical = [col for col, funcs in spec['aggregators'].items()
+                 if set(funcs) & set(numerical_aggregators)]
+    nunique = [col for col, funcs in spec['aggregators'].items() if 'nunique' in funcs]
+    counted = list(dict.fromkeys(spec['ratio_columns'] + spec['top_columns']))
+    return numerical, nunique, counted
+
+
+def plain_values(values):
+    '''Returns the given series (categorical or not) as a series of objects, so
+    that values from different tables (with different categories) compare and
+    hash the same.'''
+    return values.astype(object)
+
+
+def json_value(value):
+    '''Turns numpy scalars into python ones, so they can be stored as json.'''
+    return value.item() if isinstance(value, np.generic) else value
+
+
+def value_order(values):
+    '''Returns the (non-nan) values of the given series in the order that
+    `aggregation.top_value_codes` breaks ties in, i.e. their natural sort order
+    (see `aggregation.value_codes`).'''
+    if values.dtype.name == 'category':
+        return [json_value(v) for v in values.cat.categories.sort_values()]
+    return [json_value(v) for v in sorted(values.dropna().unique())]
+
+
+@instrumented()
+def card_state(trans_df, spec, lookup=None, with_merchant=False):
+    '''Computes the aggregation state (see the top of this file) of the cards in
+    the given (cleaned) transactions, for the given table spec.
+
+    Columns that aren't in the transactions are looked up (see
+    `aggregation.aggregate_card_features`).
+    '''
+    numerical, nunique, counted = spec_columns(spec)
+    column_names = list(dict.fromkeys(numerical + nunique + counted))
+    looked_up = [col for col in column_names if col not in trans_df.columns]
+    view = trans_df[[col for col in column_names if col not in looked_up]]
+    if looked_up:
+        key, table = lookup
+        view = view.assign(**lookup_columns(trans_df[key], table, looked_up))
+    card_ids = plain_values(trans_df['card_id'])
+
+    # Columns may be stored as float32 to save memory (see `loaders`).
+    integer_columns = [col for col in numerical if view[col].dtype.kind in 'iu']
+    view = view.astype({col: np.float64 for col in numerical
+                        if view[col].dtype == np.float32})
+    grouped = view[numerical].groupby(card_ids.values)
+    stats = {'count': grouped.count(),
+             'sum': grouped.sum(),
+             'mean': grouped.mean(),
+             'm2': grouped.var(ddof=0) * grouped.count(),
+             'min': grouped.min(),
+             'max': grouped.max()}
+    numerical_df = pd.DataFrame({f'{col}:{stat}': stats[stat][col]
+                                 for col in numerical for stat in numerical_stats})
+    numerical_df.index.name = 'card_id'
+
+    distinct = {}
+    for col in nunique:
+        pairs = pd.DataFrame({'card_id': card_ids.values,
+                              'value': plain_values(view[col]).values})
+        distinct[col] = pairs.dropna().drop_duplicates().reset_index(drop=True)
+
+    counts = {}
+    for col in counted:
+        pairs = pd.DataFrame({'card_id': card_ids.values,
+                              'value': plain_values(view[col]).values}).dropna()
+        counts[col] = pairs.groupby(['card_id', 'value']).size().rename('count').reset_index()
+
+    elapsed = pd.DataFrame({'card_id': card_ids.values,
+                            'merchant_id': plain_values(trans_df['merchant_id']).values,
+                            'last': trans_df['purchase_Elapsed'].values})
+    last = elapsed.groupby('card_id')['last'].max().reset_index()
+    last_merchant = None
+    if with_merchant:
+        last_merchant = elapsed.groupby(['card_id', 'merchant_id'], dropna=False)['last'].max().reset_index()
+
+    meta = {'integer_columns': integer_columns,
+            'ratio_values': {col: [json_value(v) for v in values]
+                             for col, values in get_ratio_values(view, spec['ratio_columns']).items()},
+            'value_order': {col: value_order(view[col]) for col in spec['top_columns']}}
+
+    return {'numerical': numerical_df,
+            'distinct': distinct,
+            'counts': counts,
+            'last': last,
+            'last_merchant': last_merchant,
+            'meta': meta}
+
+
+def merge_numerical(a, b, numerical):
+    '''Merges two data frames of numerical state (indexed by card id).
+
+    The std is merged with the parallel algorithm of Chan et al.: the sums of
+    squared differences from the mean of both parts are added, plus a term for
+    the difference between the means of the parts, which gives the same result
+    as computing it over all values at once.
+    '''
+    cards = a.index.union(b.index)
+    a, b = a.reindex(cards), b.reindex(cards)
+    merged = {}
+    for col in numerical:
+        n_a = a[f'{col}:count'].fillna(0)
+        n_b = b[f'{col}:count'].fillna(0)
+        n = n_a + n_b
+        mean_a = a[f'{col}:mean'].fillna(0)
+        mean_b = b[f'{col}:mean'].fillna(0)
+        delta = mean_b - mean_a
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = (mean_a + delta * n_b / n).where(n > 0)
+            m2 = (a[f'{col}:m2'].fillna(0) + b[f'{col}:m2'].fillna(0) +
+                  (delta ** 2 * n_a * n_b / n).fillna(0))
+        merged[f'{col}:count'] = n
+        merged[f'{col}:sum'] = a[f'{col}:sum'].fillna(0) + b[f'{col}:sum'].fillna(0)
+        merged[f'{col}:mean'] = mean
+        merged[f'{col}:m2'] = m2.where(n > 0)
+        merged[f'{col}:min'] = np.fmin(a[f'{col}:min'], b[f'{col}:min'])
+        merged[f'{col}:max'] = np.fmax(a[f'{col}:max'], b[f'{col}:max'])
+    result = pd.DataFrame(merged, index=cards, columns=list(a.columns))
+    result.index.name = 'card_id'
+    return result
+
+
+@instrumented()
+def merge_states(old, new, spec):
+    '''Merges the state of some new transactions into that of the old ones, as
+    if it had been computed from all of them (with the new transactions coming
+    after the old ones).'''
+    numerical, nunique, counted = spec_columns(spec)
+
+    distinct = {col: pd.concat([old['distinct'][col], new['distinct'][col]])
+                       .drop_duplicates().reset_index(drop=True)
+                for col in nunique}
+    counts = {col: pd.concat([old['counts'][col], new['counts'][col]])
+                     .groupby(['card_id', 'value'])['count'].sum().reset_index()
+              for col in counted}
+
+    def merge_last(old_last, new_last, keys):
+        if old_last is None:
+            return None
+        return (pd.concat([old_last, new_last])
+                  .groupby(keys, dropna=False)['last'].max().reset_index())
+
+    old_meta, new_meta = old['meta'], new['meta']
+    meta = {
+        # If there's any nan in the new values, a full recompute would have
+        # turned the integers into floats, too.
+        'integer_columns': [col for col in old_meta['integer_columns']
+                            if col in new_meta['integer_columns']],
+        'ratio_values': {col: sorted(set(values) | set(new_meta['ratio_values'][col]))
+                         for col, values in old_meta['ratio_values'].items()},
+        'value_order': {col: sorted(set(values) | set(new_meta['value_order'][col]))
+                        for col, values in old_meta['value_order'].items()},
+    }
+
+    return {'numerical': merge_numerical(old['numerical'], new['numerical'], numerical),
+            'distinct': distinct,
+            'counts': counts,
+            'last': merge_last(old['last'], new['last'], ['card_id']),
+            'last_merchant': merge_last(old['last_merchant'], new['last_merchant'],
+                                        ['card_id', 'merchant_id']),
+            'meta': meta}
+
+
+def top_values(counts, order, cards):
+    '''Returns the most common value of every given card from the given counts
+    of (card, value) pairs, breaking ties in the given order of the values, as
+    `aggregation.top_value_codes` does.'''
+    counts = counts[counts['card_id'].isin(cards)]
+    ranks = pd.Index(order).get_indexer(counts['value'])
+    rows = np.lexsort((ranks, -counts['count'].values, counts['card_id'].values))
+    first = counts.iloc[rows].drop_duplicates('card_id')
+    return pd.Series(first['value'].values, index=first['card_id'].values).reindex(cards).values
+
+
+def feature_columns(state, spec):
+    '''Returns the names of the features that `state_features` computes from the
+    given state, in order.'''
+    prefix = spec['prefix']
+    return ([f'{prefix}{col}_{f}' for col, funcs in spec['aggregators'].items() for f in funcs] +
+            [f'{prefix}{col}_{value}_ratio' for col in spec['ratio_columns']
+             for value in state['meta']['ratio_values'][col]] +
+            [f'{prefix}{col}_top' for col in spec['top_columns']])
+
+
+@instrumented()
+def state_features(state, spec, cards):
+    '''Returns a data frame (indexed by the given card ids) with the features of
+    the given table spec computed from the given state, with the same columns
+    and values (up to floating point rounding) as
+    `aggregation.aggregate_card_features` gives for the transactions of the
+    state.'''
+    numerical, nunique, counted = spec_columns(spec)
+    meta = state['meta']
+    prefix = spec['prefix']
+    has_all_cards = cards.isin(state['numerical'].index).all()
+    numerical_df = state['numerical'].reindex(cards)
+
+    features = {}
+    for col, funcs in spec['aggregators'].items():
+        for f in funcs:
+            if f == 'nunique':
+                distinct = state['distinct'][col]
+                values = (distinct.groupby('card_id').size()
+                          .reindex(cards, fill_value=0).astype(np.int64).values)
+            else:
+                n = numerical_df[f'{col}:count']
+                if f == 'sum':
+                    values = numerical_df[f'{col}:sum'].fillna(0)
+                elif f == 'mean':
+                    with np.errstate(invalid='ignore', divide='ignore'):
+                        values = (numerical_df[f'{col}:sum'] / n).where(n > 0)
+                elif f == 'std':
+                    with np.errstate(invalid='ignore', divide='ignore'):
+                        values = np.sqrt(numerical_df[f'{col}:m2'] / (n - 1)).where(n > 1)
+                else:
+                    values = numerical_df[f'{col}:{f}']
+                # Like pandas, keep integers integers if there are no nans.
+                if (f in ['sum', 'min', 'max'] and col in meta['integer_columns']
+                        and has_all_cards and not values.isnull().any()):
+                    values = values.astype(np.int64)
+                values = values.values
+            features[f'{prefix}{col}_{f}'] = values
+
+    for col in spec['ratio_columns']:
+        counts = state['counts'][col]
+        counts = counts[counts['card_id'].isin(cards)]
+        by_value = counts.pivot_table(index='card_id', columns='value', values='count',
+                                      aggfunc='sum', fill_value=0).reindex(cards)
+        total = by_value.sum(axis=1, min_count=1).fillna(0).values
+        with np.errstate(invalid='ignore', divide='ignore'):
+            for value in meta['ratio_values'][col]:
+                value_counts = (by_value[value].fillna(0).values if value in by_value.columns
+                                else np.zeros(len(cards)))
+                features[f'{prefix}{col}_{value}_ratio'] = value_counts / total
+
+    for col in spec['top_columns']:
+        features[f'{prefix}{col}_top'] = top_values(state['counts'][col],
+                                                    meta['value_order'][col], cards)
+
+    result = pd.DataFrame(features, index=cards, columns=list(features))
+    for col in spec['top_columns']:
+        name = f'{prefix}{col}_top'
+        result[name] = result[name].astype('category').cat.as_ordered()
+    return result
+
+
+def write_state(state, state_dir):
+    '''Writes the given state to the given directory, replacing what was there
+    before.'''
+    tmp_dir = state_dir.rstrip('/') + '.tmp'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    write_frame(state['numerical'], os.path.join(tmp_dir, 'numerical.parquet'))
+    for kind in ['distinct', 'counts']:
+        for col, df in state[kind].items():
+            write_frame(df, os.path.join(tmp_dir, f'{kind}-{col}.parquet'))
+    write_frame(state['last'], os.path.join(tmp_dir, 'last.parquet'))
+    if state['last_merchant'] is not None:
+        write_frame(state['last_merchant'], os.path.join(tmp_dir, 'last_merchant.parquet'))
+    with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+        json.dump(state['meta'], f)
+    # Only replace the old state once the new one is complete.
+    shutil.rmtree(state_dir, ignore_errors=True)
+    os.replace(tmp_dir, state_dir)
+
+
+def read_state(state_dir):
+    '''Reads the state written by `write_state` from the given directory.'''
+    with open(os.path.join(state_dir, 'meta.json')) as f:
+        meta = json.load(f)
+    spec = table_spec(meta['table'])
+    numerical, nunique, counted = spec_columns(spec)
+
+    def read(name):
+        df = read_frame(os.path.join(state_dir, f'{name}.parquet'))
+        # Read the values back as objects again, see `plain_values`.
+        for col in ['card_id', 'merchant_id', 'value']:
+            if col in df.columns:
+                df[col] = plain_values(df[col])
+        return df
+
+    last_merchant = None
+    if os.path.exists(os.path.join(state_dir, 'last_merchant.parquet')):
+        last_merchant = read('last_merchant')
+
+    return {'numerical': read('numerical'),
+            'distinct': {col: read(f'distinct-{col}') for col in nunique},
+            'counts': {col: read(f'counts-{col}') for col in counted},
+            'last': read('last'),
+            'last_merchant': last_merchant,
+            'meta': meta}
+
+
+def add_elapsed_since_state(trans_df, last, group_columns, column):
+    '''Adds the time since the last purchase in the same group (as given by
+    `group_columns`) to the given new transactions (sorted by date), taking the
+    last purchase of every group before the new transactions from the given
+    data frame of the group columns and their `last` purchase_Elapsed.
+
+    The given data frame is mutated in place.
+    '''
+    elapsed = elapsed_since_last_in_group(trans_df, group_columns)
+    keys = pd.DataFrame({col: plain_values(trans_df[col]).values for col in group_columns})
+    previous = keys.merge(last, on=group_columns, how='left')['last'].values
+    first_of_group = ~keys.duplicated().values
+    elapsed[first_of_group] = (trans_df['purchase_Elapsed'].values[first_of_group] -
+                               previous[first_of_group])
+    trans_df[column] = elapsed
+
+
+@instrumented()
+def clean_new_transactions(filename, state, with_merchant):
+    '''Loads and cleans the new (raw) transactions in the given csv like
+    `clean_transactions.py` does, but taking the times since the last purchases
+    before them from the given state.
+
+    This only gives the same result as cleaning all transactions at once if none
+    of the new transactions of a card happened before its latest old one, so we
+    refuse to do it otherwise.
+    '''
+    trans_df = load_transactions(filename)
+    prepare_transactions(trans_df)
+    trans_df.sort_values(by=['purchase_Elapsed'], kind='mergesort', inplace=True)
+
+    last = state['last'].set_index('card_id')['last']
+    previous = last.reindex(plain_values(trans_df['card_id'])).values
+    too_old = trans_df['purchase_Elapsed'].values < previous
+    if too_old.any():
+        raise ValueError(f'{too_old.sum()} of the new transactions happened before the latest '
+                         'transaction of their card, so the times since the last purchases of '
+                         'the old transactions change, too. Recompute all features instead.')
+
+    add_elapsed_since_state(trans_df, state['last'], ['card_id'],
+                            'elapsed_since_last_purchase')
+    if with_merchant:
+        add_elapsed_since_state(trans_df, state['last_merchant'],
+                                ['card_id', 'merchant_id'],
+                                'elapsed_since_last_merch_purchase')
+    return trans_df
+
+
+def init_state(state_dir, table, trans_file, merchants_file):
+    '''Computes the state of the given table ('historical' or 'new') from the
+    given cleaned transactions (see `clean_transactions.py`, not joined with the
+    merchants) and writes it to the given directory.'''
+    spec = table_spec(table)
+    trans_df = rename_transaction_columns(load_processed(trans_file))
+    merchants_df = merchant_lookup_table(load_processed(merchants_file))
+    print(f'Computing the aggregation state of {trans_file} ...')
+    state = card_state(trans_df, spec, lookup=('merchant_id', merchants_df),
+                       with_merchant=table == 'historical')
+    state['meta']['table'] = table
+    write_state(state, state_dir)
+
+
+def record_delta(delta_csv, deltas_dir):
+    '''Copies the given csv of new transactions to the given directory, after the
+    ones that are there already, so that cleaning the transactions (see the
+    --deltas_dir option of `clean_transactions.py`) includes them from now on.'''
+    os.makedirs(deltas_dir, exist_ok=True)
+    name = f'{len(delta_files(deltas_dir)):05d}-{os.path.basename(delta_csv)}'
+    # Copy to a hidden file first, so that half a copy is never taken for a delta.
+    tmp_filename = os.path.join(deltas_dir, f'.{name}.tmp')
+    shutil.copyfile(delta_csv, tmp_filename)
+    os.replace(tmp_filename, os.path.join(deltas_dir, name))
+
+
+def update_features(state_dir, delta_csv, merchants_file, feature_files,
+                    deltas_dir=None, matrix_dir=None):
+    '''Adds the new (raw) transactions in the given csv to the state in the given
+    directory, and then updates the features of the cards with new transactions
+    in the given feature files (see `feature_engineering.py`) in place.
+
+    If the new transactions add ratio columns (i.e. they have values that the
+    old ones didn't), those columns are added for all cards.
+
+    The new transactions are recorded in `deltas_dir` if given (see
+    `record_delta`), so that features computed from the cleaned transactions
+    later on (e.g. by `pipeline.py`) include them, too. If `matrix_dir` is
+    given, the feature matrices of the feature files in it (see the --matrix_dir
+    option of `feature_engineering.py`) are written again as well, with the
+    categories of the first feature file for all of them.
+    '''
+    state = read_state(state_dir)
+    table = state['meta']['table']
+    spec = table_spec(table)
+    with_merchant = table == 'historical'
+
+    print(f'Cleaning the new transactions in {delta_csv} ...')
+    delta_df = rename_transaction_columns(
+        clean_new_transactions(delta_csv, state, with_merchant))
+    merchants_df = merchant_lookup_table(load_processed(merchants_file))
+    delta_state = card_state(delta_df, spec, lookup=('merchant_id', merchants_df),
+                             with_merchant=with_merchant)
+    old_columns = feature_columns(state, spec)
+    state = merge_states(state, delta_state, spec)
+    state['meta']['table'] = table
+    affected = pd.Index(delta_state['numerical'].index)
+    print(f'Updated the aggregation state of {len(affected)} cards ...')
+
+    if deltas_dir is not None:
+        record_delta(delta_csv, deltas_dir)
+
+    categories = None
+    for filename in feature_files:
+        # Read floats back exactly as they were written, so that the features
+        # of the other cards don't change.
+        features_df = read_frame(filename, index_col='card_id',
+                                 float_precision='round_trip')
+        new_columns = feature_columns(state, spec)
+        if new_columns == old_columns:
+            cards = features_df.index[features_df.index.isin(affected)]
+        else:
+            cards = features_df.index
+        print(f'Updating the features of {len(cards)} cards in {filename} ...')
+        updated = state_features(state, spec, cards)
+
+        # Put the updated columns where the old ones were.
+        others = [col for col in features_df.columns if col not in old_columns]
+        start = sum(1 for col in features_df.columns[:features_df.columns.get_loc(old_columns[0])]
+                    if col not in old_columns)
+        block = pd.concat([features_df.loc[~features_df.index.isin(cards), old_columns],
+                           updated]).loc[features_df.index, new_columns]
+        features_df = pd.concat([features_df[others[:start]], block,
+                                 features_df[others[start:]]], axis=1)
+        write_frame(features_df, filename)
+        if matrix_dir is not None:
+            categories = write_feature_matrix(features_df, matrix_dirname(matrix_dir, filename),
+                                              categories)
+
+    write_state(state, state_dir)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Incrementally update the aggregated features with new transactions.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    init_parser = subparsers.add_parser('init', help='Compute the aggregation state of a cleaned '
+                                                     'transactions table.')
+    init_parser.add_argument('state_dir', type=str,
+                             help='Directory to write the state to.')
+    init_parser.add_argument('table', type=str, choices=['historical', 'new'],
+                             help='Which of the two transactions tables this is.')
+    init_parser.add_argument('transactions_file', type=str,
+                             help='Filename of the cleaned transactions (not joined with merchants).')
+
+    update_parser = subparsers.add_parser('update', help='Add new transactions to the state and '
+                                                         'update the features of their cards.')
+    update_parser.add_argument('state_dir', type=str,
+                               help='Directory of the state (see init).')
+    update_parser.add_argument('transactions_csv', type=str,
+                               help='Filename of a csv of new (raw) transactions.')
+    update_parser.add_argument('feature_files', type=str, nargs='+',
+                               help='Filenames of the features (e.g. train and test) to update.')
+    update_parser.add_argument('--deltas_dir', type=str, default=None,
+                               help='Directory to record the new transactions in, so that they\'re '
+                                    'cleaned along with the others from now on (see the '
+                                    '--deltas_dir option of clean_transactions.py). Without it, '
+                                    'recomputing the features from the cleaned transactions loses '
+                                    'the update.')
+    update_parser.add_argument('--matrix_dir', type=str, default=None,
+                               help='Directory of the feature matrices of the feature files (see '
+                                    'the --matrix_dir option of feature_engineering.py) to write '
+                                    'again, too. The categories of the first feature file are used '
+                                    'for all of them, so give the train features first.')
+
+    for subparser in [init_parser, update_parser]:
+        subparser.add_argument('--merchants', type=str, default='data/processed/merchants.parquet',
+                               help='Filename of the cleaned merchants.')
+        add_instrumentation_arguments(subparser)
+    args = vars(parser.parse_args())
+    configure_from_args(args)
+
+    if args['command'] == 'init':
+        init_state(args['state_dir'], args['table'], args['transactions_file'],
+                   args['merchants'])
+    else:
+        update_features(args['state_dir'], args['transactions_csv'], args['merchants'],
+                        args['feature_files'],
+                        deltas_dir=args['deltas_dir'],
+                        matrix_dir=args['matrix_dir'])
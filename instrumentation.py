@@ -0,0 +1,219 @@
+import functools
+import json
+import os
+import resource
+import sys
+import time
+from contextlib import contextmanager
+
+import pandas as pd
+
+
+# Every step of the scripts is run as a stage (see `stage` and `instrumented`),
+# which logs one line of json with its elapsed time, rows and memory of the data
+# frames going in and out, and the resident set size (RSS) of the process, so
+# that we can tell which step a slow or out of memory run got stuck in.
+#
+# Stages can be nested, their names are then joined with '/', e.g.
+# 'process_data/add_transaction_features/add_card_features[historical]'.
+_settings = {
+    # File to append the json lines to, or None for stderr.
+    'stage_log': None,
+    # Directory to write a cProfile file for every stage to, or None.
+    'profile_dir': None,
+    # List that all records are appended to as well (see `recording`), or None.
+    'records': None,
+}
+
+# The stages that are currently running, outermost first.
+_running = []
+
+
+def configure(stage_log=None, profile_dir=None):
+    '''Sets where the stage records are logged to (a filename, or None for
+    stderr) and, if `profile_dir` is given, turns on profiling every stage with
+    cProfile, writing `<stage>.prof` files to that directory.'''
+    _settings['stage_log'] = stage_log
+    _settings['profile_dir'] = profile_dir
+    if profile_dir:
+        os.makedirs(profile_dir, exist_ok=True)
+
+
+def current_settings():
+    '''Returns the arguments of the last call of `configure`, e.g. to configure
+    worker processes the same way.'''
+    return {'stage_log': _settings['stage_log'], 'profile_dir': _settings['profile_dir']}
+
+
+def add_instrumentation_arguments(parser):
+    '''Adds the command line options for `configure` to the given argparse
+    parser.'''
+    parser.add_argument('--stage_log', type=str, default=None,
+                        help='File to append the json records of the stages (time, rows, memory) '
+                             'to. Defaults to stderr.')
+    parser.add_argument('--profile_dir', type=str, default=None,
+                        help='If given, profile every stage with cProfile and write the results '
+                             'to this directory (one .prof file per stage, see pstats).')
+
+
+def configure_from_args(args):
+    '''Calls `configure` with the options added by
+    `add_instrumentation_arguments` of the given (vars of the) parsed args.'''
+    configure(stage_log=args.get('stage_log'), profile_dir=args.get('profile_dir'))
+
+
+@contextmanager
+def recording():
+    '''Collects the records of all stages in the with block in the list yielded
+    (in addition to logging them).'''
+    previous = _settings['records']
+    records = []
+    _settings['records'] = records
+    try:
+        yield records
+    finally:
+        _settings['records'] = previous
+
+
+def rss_status(field):
+    '''Returns the given field (e.g. 'VmRSS' or 'VmHWM') of /proc/self/status in
+    bytes, or None if there's no such file (i.e. we aren't on Linux).'''
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(f'{field}:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def reset_peak_rss():
+    '''Resets the peak RSS of this process to its current RSS, so that
+    `peak_rss` measures the peak of what comes after. This only works on Linux,
+    elsewhere the peak stays that of the whole process.'''
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def peak_rss():
+    '''Returns the peak RSS of this process (since the last `reset_peak_rss`)
+    in bytes.'''
+    peak = rss_status('VmHWM')
+    if peak is None:
+        # ru_maxrss is in kilobytes on Linux (and bytes on macOS).
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return peak
+
+
+def frame_info(df):
+    '''Returns the number of rows and memory (in MB) of the given data frame, or
+    a pair of Nones if it isn't one.'''
+    if not isinstance(df, (pd.DataFrame, pd.Series)):
+        return None, None
+    return len(df), round(df.memory_usage(deep=True).sum() / 2**20, 1)
+
+
+def log_record(record):
+    '''Logs the given stage record as a line of json (see `configure`).'''
+    if _settings['records'] is not None:
+        _settings['records'].append(record)
+    line = json.dumps(record, default=str)
+    if _settings['stage_log']:
+        with open(_settings['stage_log'], 'a') as f:
+            f.write(line + '\n')
+    else:
+        print(line, file=sys.stderr, flush=True)
+
+
+@contextmanager
+def stage(name, df=None):
+    '''Runs the code in the with block as a stage with the given name, and logs
+    its record when it's done: elapsed time, rows and memory of `df` going in,
+    rows and memory of what goes out, and RSS.
+
+    What goes out is whatever the code in the block sets as `output` of the
+    yielded record, e.g. `record['output'] = result`, or else `df` (for steps
+    that mutate the given data frame in place).
+    '''
+    rows_in, memory_in = frame_info(df)
+
+    # Resetting the peak RSS for this stage would lose the peak of the stage
+    # it's nested in so far, so we remember that one first.
+    if _running:
+        _running[-1]['peak'] = max(_running[-1]['peak'], peak_rss())
+    reset_peak_rss()
+
+    path = '/'.join([s['name'] for s in _running] + [name])
+    profile_dir = _settings['profile_dir']
+    # Only one profiler can be active at a time, so nested stages are only part
+    # of the profile of the outermost one.
+    profiler = None
+    if profile_dir and not any(s['profiler'] for s in _running):
+        import cProfile
+        profiler = cProfile.Profile()
+
+    record = {}
+    running = {'name': name, 'peak': 0, 'profiler': profiler}
+    _running.append(running)
+    start_time = time.time()
+    start = time.perf_counter()
+    if profiler:
+        profiler.enable()
+    try:
+        yield record
+    finally:
+        if profiler:
+            profiler.disable()
+        seconds = time.perf_counter() - start
+        _running.pop()
+        peak = max(running['peak'], peak_rss())
+        if _running:
+            _running[-1]['peak'] = max(_running[-1]['peak'], peak)
+
+        rows_out, memory_out = frame_info(record.get('output', df))
+        current = rss_status('VmRSS')
+        log = {'stage': path,
+               'pid': os.getpid(),
+               'start': round(start_time, 3),
+               'seconds': round(seconds, 4),
+               'rows_in': rows_in,
+               'rows_out': rows_out,
+               'memory_in_mb': memory_in,
+               'memory_out_mb': memory_out,
+               'rss_mb': None if current is None else round(current / 2**20, 1),
+               'peak_rss_mb': round(peak / 2**20, 1)}
+        if profiler:
+            filename = os.path.join(profile_dir,
+                                    path.replace('/', '.').replace(' ', '') + '.prof')
+            profiler.dump_stats(filename)
+            log['profile'] = filename
+        log_record(log)
+
+
+def instrumented(name=None):
+    '''Decorator that runs every call of the decorated function as a stage (see
+    `stage`) with the given name (the name of the function by default).
+
+    The first argument of the call that's a data frame is what goes in, and the
+    return value is what goes out if it's a data frame (otherwise that first
+    argument, which the function presumably mutated in place).
+    '''
+    def decorate(function):
+        stage_name = name or function.__name__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            df = next((a for a in args if isinstance(a, pd.DataFrame)), None)
+            with stage(stage_name, df) as record:
+                result = function(*args, **kwargs)
+                if isinstance(result, pd.DataFrame):
+                    record['output'] = result
+                return result
+
+        return wrapper
+
+    return decorate
@@ -1,27 +1,57 @@
 import numpy as np
 import pandas as pd
 
+from instrumentation import add_instrumentation_arguments, configure_from_args, instrumented
+from loaders import load_processed
+from storage import write_frame
+
+# The columns that are in both the transactions and the merchants tables. In
+# the joined table they get a suffix saying which table they came from.
+shared_columns = ['category_1', 'merchant_category_id', 'subsector_id']
+
+transaction_columns = {col: f'{col}_transaction' for col in shared_columns}
+merchant_columns = {col: f'{col}_merchant' for col in shared_columns}
+
+
+@instrumented()
 def join_transactions_with_merchants(transactions_df, merchants_df):
     joined = pd.merge(transactions_df, merchants_df, on='merchant_id', how='left')
-    joined_renamed = joined.rename(columns={'category_1_x': 'category_1_transaction',
-                                            'category_1_y': 'category_1_merchant',
-                                            'merchant_category_id_x': 'merchant_category_id_transaction',
-                                            'merchant_category_id_y': 'merchant_category_id_merchant',
-                                            'subsector_id_x': 'subsector_id_transaction',
-                                            'subsector_id_y': 'subsector_id_merchant'})
+    joined_renamed = joined.rename(columns={**{f'{col}_x': new for col, new in transaction_columns.items()},
+                                            **{f'{col}_y': new for col, new in merchant_columns.items()}})
     return joined_renamed
 
 
+def rename_transaction_columns(transactions_df):
+    '''Returns the given (not joined) transactions with their columns named the
+    way they are in the joined table.'''
+    return transactions_df.rename(columns=transaction_columns)
+
+
+def merchant_lookup_table(merchants_df):
+    '''Returns the given merchants (indexed by merchant id) with their columns
+    named the way they are in the joined table.
+
+    Instead of joining the merchants to every transaction, the aggregations can
+    look up the merchant columns they need in this table by the transactions'
+    merchant ids (see `aggregation.aggregate_card_features`), which gives the
+    same features without ever writing or loading the joined tables.'''
+    return merchants_df.rename(columns=merchant_columns)
+
+
 if __name__=="__main__":
     import argparse
 
     parser = argparse.ArgumentParser(description="Join transactions data with merchants data.")
-    parser.add_argument('transactions_csv', type=str, help='Filename of the transactions csv')
-    parser.add_argument('outfile', type=str, help='Filename of the result csv.')
+    parser.add_argument('transactions_file', type=str, help='Filename of the cleaned transactions.')
+    parser.add_argument('outfile', type=str, help='Filename of the result (.parquet, .feather or .csv).')
+    parser.add_argument('--merchants', type=str, default='data/processed/merchants.parquet',
+                        help='Filename of the cleaned merchants.')
+    add_instrumentation_arguments(parser)
     args = vars(parser.parse_args())
+    configure_from_args(args)
 
-    merchants_df = pd.read_csv('data/processed/merchants.csv')
-    trans_df = pd.read_csv(args['transactions_csv'])
+    merchants_df = load_processed(args['merchants'])
+    trans_df = load_processed(args['transactions_file'])
 
     joined_df = join_transactions_with_merchants(trans_df, merchants_df)
-    joined_df.to_csv(args['outfile'])
+    write_frame(joined_df, args['outfile'])
@@ -0,0 +1,186 @@
+import numpy as np
+import pandas as pd
+from pandas.api.types import CategoricalDtype
+
+from instrumentation import instrumented
+from storage import read_frame
+
+
+# A category that can take 'Y' and 'N' values and in addition a value 'Both'
+# to indicate the we've seen both values for this merchant.
+cat_triple = CategoricalDtype(categories = ['Y', 'N', 'Both'])
+
+
+# The features 'most_recent_sales_range' and 'most_recent_purchases_range' take values
+# 'A' to 'E' where 'A' represents the highest amounts. We encode them as categrical data
+# 'A' < 'B' < ...< 'E'.
+cat_most_recent = CategoricalDtype(categories=['E', 'D', 'C', 'B', 'A'], ordered=True)
+
+
+# The flags are either 'Y' or 'N'.
+cat_flag = CategoricalDtype(categories=['N', 'Y'], ordered=True)
+
+
+# Explicit dtypes for the columns of the raw csvs. IDs with string values are
+# categorical (so every distinct ID is stored only once), numerical IDs and
+# other integers get the smallest integer type that fits all their values in
+# the Kaggle data. Floats are read as float64 and only downcast by
+# `compact_frame` if that doesn't lose any precision.
+transactions_dtypes = {
+    'authorized_flag': cat_flag,
+    'card_id': 'category',
+    'city_id': np.int16,
+    'category_1': cat_flag,
+    'installments': np.int16,
+    'category_3': CategoricalDtype(categories=['A', 'B', 'C'], ordered=True),
+    'merchant_category_id': np.int16,
+    'merchant_id': 'category',
+    'month_lag': np.int8,
+    'purchase_amount': np.float64,
+    'category_2': CategoricalDtype(categories=[1., 2., 3., 4., 5.], ordered=True),
+    'state_id': np.int8,
+    'subsector_id': np.int8,
+}
+
+merchants_dtypes = {
+    'merchant_id': 'category',
+    'merchant_group_id': np.int32,
+    'merchant_category_id': np.int16,
+    'subsector_id': np.int8,
+    'numerical_1': np.float64,
+    'numerical_2': np.float64,
+    'category_1': cat_triple,
+    'most_recent_sales_range': cat_most_recent,
+    'most_recent_purchases_range': cat_most_recent,
+    'avg_sales_lag3': np.float64,
+    'avg_purchases_lag3': np.float64,
+    'active_months_lag3': np.int8,
+    'avg_sales_lag6': np.float64,
+    'avg_purchases_lag6': np.float64,
+    'active_months_lag6': np.int8,
+    'avg_sales_lag12': np.float64,
+    'avg_purchases_lag12': np.float64,
+    'active_months_lag12': np.int8,
+    'category_4': cat_triple,
+    'city_id': np.int16,
+    'state_id': np.int8,
+    'category_2': np.float64,
+}
+
+cards_dtypes = {
+    'feature_1': np.int8,
+    'feature_2': np.int8,
+    'feature_3': np.int8,
+    'target': np.float64,
+}
+
+
+def memory_usage(df):
+    '''Returns the number of bytes taken up by the given data frame.'''
+    return df.memory_usage(deep=True).sum()
+
+
+def report_memory(df, name, before=None):
+    '''Prints the memory taken up by the given data frame (and, if given, the
+    number of bytes it took up before).'''
+    after = memory_usage(df)
+    if before is None:
+        print(f'{name}: {len(df)} rows, {after / 2**20:.1f} MB')
+    else:
+        print(f'{name}: {len(df)} rows, {before / 2**20:.1f} MB -> {after / 2**20:.1f} MB')
+
+
+def downcast_integers(df, column_names):
+    '''Turns the given integer columns of the given data frame into the smallest
+    integer type that fits all their values.
+
+    The given data frame is mutated in place.
+    '''
+    for col in column_names:
+        df[col] = pd.to_numeric(df[col], downcast='integer')
+
+
+def compact_frame(df, name=None):
+    '''Makes the given data frame take up less memory, without changing any of
+    its values:
+
+    - all integer columns get the smallest integer type that fits their values,
+    - float64 columns are downcast to float32 if all their values survive that
+      unchanged, and
+    - string columns become categorical if that takes up less memory (i.e. if
+      there are a lot of duplicate values).
+
+    If `name` is given, the memory before and after is reported.
+
+    The given data frame is mutated in place, and returned for convenience.
+    '''
+    before = memory_usage(df) if name else None
+    for col in df.columns:
+        values = df[col]
+        if values.dtype.kind in 'iu':
+            df[col] = pd.to_numeric(values, downcast='integer')
+        elif values.dtype == np.float64:
+            downcast = values.astype(np.float32)
+            if np.array_equal(downcast.values.astype(np.float64), values.values,
+                              equal_nan=True):
+                df[col] = downcast
+        elif values.dtype.name != 'category' and pd.api.types.is_string_dtype(values.dtype):
+            if values.nunique() < len(values) / 2:
+                df[col] = values.astype('category')
+    if name:
+        report_memory(df, name, before)
+    return df
+
+
+def compact_datepart(df, prefix):
+    '''Gives the integer columns added by fastai's `add_datepart` for a date field
+    with the given prefix (e.g. `purchase_Year`, `purchase_Elapsed`) the
+    smallest integer type that fits their values.
+
+    The given data frame is mutated in place.
+    '''
+    downcast_integers(df, [col for col in df.columns
+                           if col.startswith(prefix) and df[col].dtype.kind in 'iu'])
+
+
+@instrumented()
+def load_transactions(filename, **csv_kwargs):
+    '''Loads the raw (Kaggle) transactions csv with the given filename, using
+    the dtypes in `transactions_dtypes`. Any other arguments are passed on to
+    `pd.read_csv`, e.g. `chunksize` to get an iterator over chunks.'''
+    transactions = pd.read_csv(filename,
+                               dtype=transactions_dtypes,
+                               parse_dates=['purchase_date'],
+                               **csv_kwargs)
+    if 'chunksize' not in csv_kwargs:
+        report_memory(transactions, filename)
+    return transactions
+
+
+@instrumented()
+def load_merchants(filename='data/unzipped/merchants.csv'):
+    '''Loads the raw (Kaggle) merchants csv, using the dtypes in
+    `merchants_dtypes`.'''
+    merchants = pd.read_csv(filename, dtype=merchants_dtypes)
+    report_memory(merchants, filename)
+    return merchants
+
+
+@instrumented()
+def load_cards(filename):
+    '''Loads a raw (Kaggle) train or test csv, indexed by card id.'''
+    print(f'Loading data frame from {filename} ...')
+    cards = pd.read_csv(filename,
+                        index_col='card_id',
+                        dtype=cards_dtypes,
+                        parse_dates=['first_active_month'])
+    report_memory(cards, filename)
+    return cards
+
+
+@instrumented()
+def load_processed(filename, columns=None):
+    '''Loads one of our own intermediate files (see `storage.read_frame`) and
+    compacts it (see `compact_frame`).'''
+    print(f'Loading data frame from {filename} ...')
+    return compact_frame(read_frame(filename, columns=columns), name=filename)
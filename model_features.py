@@ -0,0 +1,268 @@
+# The features that the model of 'elo_loyalty_prediction.ipynb' is trained on.
+# The feature files have more columns than these (e.g. the ratio columns of
+# values that aren't listed here), so `hyperparam_search.py` and `predict.py`
+# select exactly these, like the notebook does.
+
+category_names = ['first_active_monthYear',
+                  'first_active_monthMonth',
+                  'first_active_monthWeek',
+                  'first_active_monthIs_quarter_start',
+                  'first_active_monthIs_year_start',
+                  'feature_1',
+                  'feature_2',
+                  'feature_3',
+                  'authorized_flag_top',
+                  'category_1_transaction_top',
+                  'category_1_merchant_top',
+                  'category_2_top',
+                  'category_3_top',
+                  'category_4_top',
+                  'subsector_id_transaction_top',
+                  'subsector_id_merchant_top',
+                  'city_id_top',
+                  'state_id_top',
+                  'purchase_Year_top',
+                  'purchase_Month_top',
+                  'purchase_Week_top',
+                  'purchase_Day_top',
+                  'purchase_Dayofweek_top',
+                  'most_recent_sales_range_top',
+                  'most_recent_purchases_range_top',
+                  'merch_authorized_flag_top',
+                  'merch_category_1_transaction_top',
+                  'merch_category_1_merchant_top',
+                  'merch_category_2_top',
+                  'merch_category_3_top',
+                  'merch_category_4_top',
+                  'merch_subsector_id_transaction_top',
+                  'merch_subsector_id_merchant_top',
+                  'merch_city_id_top',
+                  'merch_state_id_top',
+                  'merch_purchase_Year_top',
+                  'merch_purchase_Month_top',
+                  'merch_purchase_Week_top',
+                  'merch_purchase_Day_top',
+                  'merch_purchase_Dayofweek_top',
+                  'merch_most_recent_sales_range_top',
+                  'merch_most_recent_purchases_range_top',]
+continuous_names = ['first_active_monthElapsed',
+                    'purchase_amount_sum',
+                    'purchase_amount_mean',
+                    'purchase_amount_min',
+                    'purchase_amount_max',
+                    'purchase_amount_std',
+                    'installments_sum',
+                    'installments_mean',
+                    'installments_min',
+                    'installments_max',
+                    'installments_std',
+                    'month_lag_mean',
+                    'month_lag_min',
+                    'month_lag_max',
+                    'merchant_id_nunique',
+                    'state_id_nunique',
+                    'city_id_nunique',
+                    'numerical_1_sum',
+                    'numerical_1_mean',
+                    'numerical_1_min',
+                    'numerical_1_max',
+                    'numerical_1_std',
+                    'numerical_2_sum',
+                    'numerical_2_mean',
+                    'numerical_2_min',
+                    'numerical_2_max',
+                    'numerical_2_std',
+                    'avg_sales_lag3_sum',
+                    'avg_sales_lag3_mean',
+                    'avg_sales_lag3_min',
+                    'avg_sales_lag3_max',
+                    'avg_sales_lag3_std',
+                    'avg_sales_lag6_sum',
+                    'avg_sales_lag6_mean',
+                    'avg_sales_lag6_min',
+                    'avg_sales_lag6_max',
+                    'avg_sales_lag6_std',
+                    'avg_sales_lag12_sum',
+                    'avg_sales_lag12_mean',
+                    'avg_sales_lag12_min',
+                    'avg_sales_lag12_max',
+                    'avg_sales_lag12_std',
+                    'avg_purchases_lag3_sum',
+                    'avg_purchases_lag3_mean',
+                    'avg_purchases_lag3_min',
+                    'avg_purchases_lag3_max',
+                    'avg_purchases_lag3_std',
+                    'avg_purchases_lag6_sum',
+                    'avg_purchases_lag6_mean',
+                    'avg_purchases_lag6_min',
+                    'avg_purchases_lag6_max',
+                    'avg_purchases_lag6_std',
+                    'avg_purchases_lag12_sum',
+                    'avg_purchases_lag12_mean',
+                    'avg_purchases_lag12_min',
+                    'avg_purchases_lag12_max',
+                    'avg_purchases_lag12_std',
+                    'active_months_lag3_sum',
+                    'active_months_lag3_mean',
+                    'active_months_lag3_min',
+                    'active_months_lag3_std',
+                    'active_months_lag6_sum',
+                    'active_months_lag6_mean',
+                    'active_months_lag6_min',
+                    'active_months_lag6_std',
+                    'active_months_lag12_sum',
+                    'active_months_lag12_mean',
+                    'active_months_lag12_min',
+                    'active_months_lag12_max',
+                    'active_months_lag12_std',
+                    'merchant_category_id_transaction_nunique',
+                    'merchant_category_id_merchant_nunique',
+                    'subsector_id_transaction_nunique',
+                    'subsector_id_merchant_nunique',
+                    'merchant_group_id_nunique',
+                    'most_recent_sales_range_nunique',
+                    'most_recent_purchases_range_nunique',
+                    'elapsed_since_last_purchase_sum',
+                    'elapsed_since_last_purchase_mean',
+                    'elapsed_since_last_purchase_min',
+                    'elapsed_since_last_purchase_max',
+                    'elapsed_since_last_purchase_std',
+                    'elapsed_since_last_merch_purchase_sum',
+                    'elapsed_since_last_merch_purchase_mean',
+                    'elapsed_since_last_merch_purchase_min',
+                    'elapsed_since_last_merch_purchase_max',
+                    'elapsed_since_last_merch_purchase_std',
+                    'authorized_flag_Y_ratio',
+                    'category_1_transaction_N_ratio',
+                    'category_1_merchant_N_ratio',
+                    'category_2_1.0_ratio',
+                    'category_2_3.0_ratio',
+                    'category_2_4.0_ratio',
+                    'category_2_2.0_ratio',
+                    'category_2_5.0_ratio',
+                    'category_3_A_ratio',
+                    'category_3_B_ratio',
+                    'category_3_C_ratio',
+                    'category_4_N_ratio',
+                    'purchase_Is_month_start_True_ratio',
+                    'purchase_Is_month_end_False_ratio',
+                    'purchase_Year_2017_ratio',
+                    'most_recent_sales_range_B_ratio',
+                    'most_recent_sales_range_A_ratio',
+                    'most_recent_sales_range_C_ratio',
+                    'most_recent_sales_range_D_ratio',
+                    'most_recent_sales_range_E_ratio',
+                    'most_recent_purchases_range_B_ratio',
+                    'most_recent_purchases_range_C_ratio',
+                    'most_recent_purchases_range_A_ratio',
+                    'most_recent_purchases_range_D_ratio',
+                    'most_recent_purchases_range_E_ratio',
+                    'merch_purchase_amount_sum',
+                    'merch_purchase_amount_mean',
+                    'merch_purchase_amount_min',
+                    'merch_purchase_amount_max',
+                    'merch_purchase_amount_std',
+                    'merch_installments_sum',
+                    'merch_installments_mean',
+                    'merch_installments_min',
+                    'merch_installments_max',
+                    'merch_installments_std',
+                    'merch_month_lag_mean',
+                    'merch_month_lag_min',
+                    'merch_month_lag_max',
+                    'merch_merchant_id_nunique',
+                    'merch_state_id_nunique',
+                    'merch_city_id_nunique',
+                    'merch_numerical_1_sum',
+                    'merch_numerical_1_mean',
+                    'merch_numerical_1_min',
+                    'merch_numerical_1_max',
+                    'merch_numerical_1_std',
+                    'merch_numerical_2_sum',
+                    'merch_numerical_2_mean',
+                    'merch_numerical_2_min',
+                    'merch_numerical_2_max',
+                    'merch_numerical_2_std',
+                    'merch_avg_sales_lag3_sum',
+                    'merch_avg_sales_lag3_mean',
+                    'merch_avg_sales_lag3_min',
+                    'merch_avg_sales_lag3_max',
+                    'merch_avg_sales_lag3_std',
+                    'merch_avg_sales_lag6_sum',
+                    'merch_avg_sales_lag6_mean',
+                    'merch_avg_sales_lag6_min',
+                    'merch_avg_sales_lag6_max',
+                    'merch_avg_sales_lag6_std',
+                    'merch_avg_sales_lag12_sum',
+                    'merch_avg_sales_lag12_mean',
+                    'merch_avg_sales_lag12_min',
+                    'merch_avg_sales_lag12_max',
+                    'merch_avg_sales_lag12_std',
+                    'merch_avg_purchases_lag3_sum',
+                    'merch_avg_purchases_lag3_mean',
+                    'merch_avg_purchases_lag3_min',
+                    'merch_avg_purchases_lag3_max',
+                    'merch_avg_purchases_lag3_std',
+                    'merch_avg_purchases_lag6_sum',
+                    'merch_avg_purchases_lag6_mean',
+                    'merch_avg_purchases_lag6_min',
+                    'merch_avg_purchases_lag6_max',
+                    'merch_avg_purchases_lag6_std',
+                    'merch_avg_purchases_lag12_sum',
+                    'merch_avg_purchases_lag12_mean',
+                    'merch_avg_purchases_lag12_min',
+                    'merch_avg_purchases_lag12_max',
+                    'merch_avg_purchases_lag12_std',
+                    'merch_active_months_lag3_sum',
+                    'merch_active_months_lag3_mean',
+                    'merch_active_months_lag3_min',
+                    'merch_active_months_lag3_max',
+                    'merch_active_months_lag3_std',
+                    'merch_active_months_lag6_sum',
+                    'merch_active_months_lag6_mean',
+                    'merch_active_months_lag6_min',
+                    'merch_active_months_lag6_max',
+                    'merch_active_months_lag6_std',
+                    'merch_active_months_lag12_sum',
+                    'merch_active_months_lag12_mean',
+                    'merch_active_months_lag12_min',
+                    'merch_active_months_lag12_max',
+                    'merch_active_months_lag12_std',
+                    'merch_merchant_category_id_transaction_nunique',
+                    'merch_merchant_category_id_merchant_nunique',
+                    'merch_subsector_id_transaction_nunique',
+                    'merch_subsector_id_merchant_nunique',
+                    'merch_merchant_group_id_nunique',
+                    'merch_most_recent_sales_range_nunique',
+                    'merch_most_recent_purchases_range_nunique',
+                    'merch_elapsed_since_last_purchase_sum',
+                    'merch_elapsed_since_last_purchase_mean',
+                    'merch_elapsed_since_last_purchase_min',
+                    'merch_elapsed_since_last_purchase_max',
+                    'merch_elapsed_since_last_purchase_std',
+                    'merch_category_1_transaction_N_ratio',
+                    'merch_category_1_merchant_N_ratio',
+                    'merch_category_2_1.0_ratio',
+                    'merch_category_2_4.0_ratio',
+                    'merch_category_2_2.0_ratio',
+                    'merch_category_2_3.0_ratio',
+                    'merch_category_2_5.0_ratio',
+                    'merch_category_3_B_ratio',
+                    'merch_category_3_A_ratio',
+                    'merch_category_3_C_ratio',
+                    'merch_category_4_Y_ratio',
+                    'merch_category_4_N_ratio',
+                    'merch_purchase_Is_month_start_True_ratio',
+                    'merch_purchase_Is_month_end_False_ratio',
+                    'merch_purchase_Year_2017_ratio',
+                    'merch_purchase_Year_2018_ratio',
+                    'merch_most_recent_sales_range_A_ratio',
+                    'merch_most_recent_sales_range_B_ratio',
+                    'merch_most_recent_sales_range_D_ratio',
+                    'merch_most_recent_sales_range_E_ratio',
+                    'merch_most_recent_sales_range_C_ratio',
+                    'merch_most_recent_purchases_range_A_ratio',
+                    'merch_most_recent_purchases_range_B_ratio',
+                    'merch_most_recent_purchases_range_D_ratio',
+                    'merch_most_recent_purchases_range_C_ratio',
+                    'merch_most_recent_purchases_range_E_ratio',]
@@ -0,0 +1,15 @@
+import numpy as np
+import pandas as pd
+
+
+def card_partitions(card_ids, n_partitions):
+    '''Returns, for each of the given card ids, the number of the partition
+    (in `[0, n_partitions)`) it's hashed to.
+
+    The hash only depends on the card id itself (not on its dtype, i.e. plain
+    strings and categorical card ids hash the same), so every transaction of a
+    card ends up in the same partition, whichever file and chunk it comes from.
+    '''
+    hashes = pd.util.hash_pandas_object(pd.Series(card_ids), index=False,
+                                        categorize=False).values
+    return (hashes % np.uint64(n_partitions)).astype(np.int64)
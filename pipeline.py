@@ -0,0 +1,379 @@
+import ast
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
+
+from feature_cache import code_digest, file_digest
+
+
+# Runs the data processing stages, deciding what to rebuild from the contents
+# of the files instead of their modification times (the targets of the Makefile
+# for the files in data/processed just call this with their stage): every
+# stage is keyed on the contents of its input files, the code of its script
+# (including the modules of this repo it imports) and its command line (see
+# `stage_key`), and is only run again if that key changed or one of its outputs
+# is missing or was changed since. Stages that don't depend on each other run
+# at the same time.
+#
+# The keys of the stages that ran, and the digests of the files, are kept in
+# `state_dir`, along with a log of the output of every stage. Only one run at a
+# time uses them, others (e.g. of several make targets with -j) wait for it.
+
+root_dir = os.path.dirname(os.path.abspath(__file__))
+state_dir = 'data/processed/.pipeline'
+
+# The historical transactions don't comfortably fit into memory, so we process
+# them in chunks of this many rows.
+historical_chunksize = 2000000
+
+# New transactions that `incremental.py update` added to the features are
+# recorded in these directories, and cleaned along with the transactions csvs
+# (see the --deltas_dir option of clean_transactions.py), so that the features
+# computed here include them, too.
+new_merchant_deltas_dir = 'data/raw/new_merchant_transactions_deltas'
+historical_deltas_dir = 'data/raw/historical_transactions_deltas'
+
+# The stages, each with the command that runs it (a script of this repo and its
+# arguments), the files (or directories) it reads, those it reads if they exist
+# (`optional_inputs`) and the ones it writes. The order of the stages doesn't
+# matter, a stage that reads what another one writes always runs after it. Only
+# the stages with `default` set are run if no stages are given on the command
+# line.
+stages = [
+    {'name': 'merchants',
+     'command': ['clean_merchants.py', 'data/processed/merchants.parquet'],
+     'inputs': ['data/unzipped/merchants.csv'],
+     'outputs': ['data/processed/merchants.parquet'],
+     'default': True},
+    {'name': 'new_merchant_transactions',
+     'command': ['clean_transactions.py',
+                 '--deltas_dir', new_merchant_deltas_dir,
+                 'data/unzipped/new_merchant_transactions.csv',
+                 'data/processed/new_merchant_transactions.parquet'],
+     'inputs': ['data/unzipped/new_merchant_transactions.csv'],
+     'optional_inputs': [new_merchant_deltas_dir],
+     'outputs': ['data/processed/new_merchant_transactions.parquet'],
+     'default': True},
+    {'name': 'historical_transactions',
+     'command': ['clean_transactions.py',
+                 '--calculate_time_since_purchase_with_merchant',
+                 '--chunksize', str(historical_chunksize),
+                 '--deltas_dir', historical_deltas_dir,
+                 'data/unzipped/historical_transactions.csv',
+                 'data/processed/historical_transactions.parquet'],
+     'inputs': ['data/unzipped/historical_transactions.csv'],
+     'optional_inputs': [historical_deltas_dir],
+     'outputs': ['data/processed/historical_transactions.parquet'],
+     'default': True},
+    {'name': 'aggregated_features',
+     'command': ['feature_engineering.py',
+                 '--cache_dir', 'data/processed/feature_cache',
+                 '--merchants', 'data/processed/merchants.parquet',
+                 '--matrix_dir', 'data/processed/feature_matrix',
+                 '--also', 'data/unzipped/test.csv',
+                 'data/processed/test_with_aggregated_features.csv',
+                 'data/unzipped/train.csv',
+                 'data/processed/historical_transactions.parquet',
+                 'data/processed/new_merchant_transactions.parquet',
+                 'data/processed/train_with_aggregated_features.csv'],
+     'inputs': ['data/unzipped/train.csv',
+                'data/unzipped/test.csv',
+                'data/processed/historical_transactions.parquet',
+                'data/processed/new_merchant_transactions.parquet',
+                'data/processed/merchants.parquet'],
+     'outputs': ['data/processed/train_with_aggregated_features.csv',
+                 'data/processed/test_with_aggregated_features.csv',
+                 'data/processed/feature_matrix/train_with_aggregated_features',
+                 'data/processed/feature_matrix/test_with_aggregated_features'],
+     'default': True},
+    {'name': 'new_merchant_transactions_state',
+     'command': ['incremental.py', 'init',
+                 '--merchants', 'data/processed/merchants.parquet',
+                 'data/processed/new_merchant_transactions_state', 'new',
+                 'data/processed/new_merchant_transactions.parquet'],
+     'inputs': ['data/processed/new_merchant_transactions.parquet',
+                'data/processed/merchants.parquet'],
+     'outputs': ['data/processed/new_merchant_transactions_state'],
+     'default': False},
+    {'name': 'submission',
+     'command': ['predict.py', 'learner/export.pkl',
+                 'data/processed/feature_matrix/test_with_aggregated_features',
+                 'submission.csv.zip'],
+     'inputs': ['learner/export.pkl',
+                'data/processed/feature_matrix/test_with_aggregated_features'],
+     'outputs': ['submission.csv.zip'],
+     'default': False},
+]
+
+
+def module_files(script):
+    '''Returns the given python file of this repo along with the files of all
+    modules of this repo that it imports, directly or not.'''
+    files, todo = [], [script]
+    while todo:
+        filename = todo.pop()
+        if filename in files:
+            continue
+        files.append(filename)
+        with open(os.path.join(root_dir, filename)) as f:
+            tree = ast.parse(f.read(), filename)
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                modules = [alias.name for alias in node.names]
+            elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+                modules = [node.module]
+            else:
+                continue
+            for module in modules:
+                module_file = module.split('.')[0] + '.py'
+                if os.path.exists(os.path.join(root_dir, module_file)):
+                    todo.append(module_file)
+    return sorted(files)
+
+
+class Digests:
+    '''Content digests of files and directories, which are only computed again
+    if the size or modification time of a file changed since the last time
+    (see `file_digest`). Safe to use from several threads.'''
+
+    def __init__(self, known=None):
+        self.known = dict(known or {})
+        self.lock = threading.Lock()
+
+    def file(self, filename):
+        stat = os.stat(filename)
+        with self.lock:
+            known = self.known.get(filename)
+        if known and known[:2] == [stat.st_size, stat.st_mtime_ns]:
+            return known[2]
+        digest = file_digest(filename)
+        with self.lock:
+            self.known[filename] = [stat.st_size, stat.st_mtime_ns, digest]
+        return digest
+
+    def snapshot(self):
+        '''Returns a copy of the known digests, e.g. to write them out while
+        other threads keep adding to them.'''
+        with self.lock:
+            return dict(self.known)
+
+    def path(self, path):
+        '''Returns the digest of the given file, or of the names and contents of
+        all files in the given directory, or None if there's no such path.'''
+        if os.path.isfile(path):
+            return self.file(path)
+        if not os.path.isdir(path):
+            return None
+        digest = hashlib.sha1()
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            for name in sorted(filenames):
+                filename = os.path.join(dirpath, name)
+                digest.update(os.path.relpath(filename, path).encode('utf-8'))
+                digest.update(self.file(filename).encode('utf-8'))
+        return digest.hexdigest()
+
+
+def all_inputs(stage):
+    '''Returns the inputs of the given stage, optional ones included.'''
+    return stage['inputs'] + stage.get('optional_inputs', [])
+
+
+def stage_key(stage, digests):
+    '''Returns the key of the given stage: a digest of the contents of its
+    inputs (None for missing optional ones), the code of its script and the
+    modules it imports (see `code_digest`), and its command line.'''
+    missing = [path for path in stage['inputs'] if not os.path.exists(path)]
+    if missing:
+        raise FileNotFoundError(f'Missing inputs of {stage["name"]}: {", ".join(missing)}')
+    key = json.dumps({'inputs': {path: digests.path(path) for path in all_inputs(stage)},
+                      'code': {filename: code_digest(os.path.join(root_dir, filename))
+                               for filename in module_files(stage['command'][0])},
+                      'command': stage['command']},
+                     sort_keys=True)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def is_up_to_date(stage, key, state, digests):
+    '''Returns whether the given stage last ran with the given key and its
+    outputs are still what it wrote then.'''
+    last = state['stages'].get(stage['name'])
+    return (last is not None and last['key'] == key and
+            all(digests.path(path) == last['outputs'].get(path) for path in stage['outputs']))
+
+
+def dependencies(stage, stages):
+    '''Returns the names of the stages that write the inputs of the given
+    stage (or files in them, or the directories they're in).'''
+    def inside(path, other):
+        return path == other or path.startswith(other + '/') or other.startswith(path + '/')
+    return [other['name'] for other in stages if other is not stage and
+            any(inside(i, o) for i in all_inputs(stage) for o in other['outputs'])]
+
+
+def needed_stages(names, stages):
+    '''Returns the given stages along with all the stages they depend on,
+    directly or not.'''
+    by_name = {stage['name']: stage for stage in stages}
+    needed, todo = [], list(names)
+    while todo:
+        name = todo.pop()
+        if name not in by_name:
+            raise ValueError(f'Unknown stage {name}, should be one of {", ".join(by_name)}.')
+        if name not in needed:
+            needed.append(name)
+            todo += dependencies(by_name[name], stages)
+    return [stage for stage in stages if stage['name'] in needed]
+
+
+def remove_outputs(stage):
+    '''Removes the outputs of the given stage, like make does with the targets
+    of rules that fail (see .DELETE_ON_ERROR in the Makefile).'''
+    for path in stage['outputs']:
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+
+
+def read_state():
+    filename = os.path.join(state_dir, 'state.json')
+    if not os.path.exists(filename):
+        return {'stages': {}, 'digests': {}}
+    with open(filename) as f:
+        return json.load(f)
+
+
+def write_state(state):
+    '''Writes the given state, replacing the previous one only once it's
+    written completely.'''
+    os.makedirs(state_dir, exist_ok=True)
+    filename = os.path.join(state_dir, 'state.json')
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(state, f, indent=1, sort_keys=True)
+    os.replace(filename + '.tmp', filename)
+
+
+def run_stage(stage, state, digests, lock, force=False, extra_args=()):
+    '''Runs the given stage unless it's up to date (or `force` is set), with its
+    output going to its log file in `state_dir`. Returns whether it ran.'''
+    key = stage_key(stage, digests)
+    if not force and is_up_to_date(stage, key, state, digests):
+        print(f'{stage["name"]} is up to date')
+        return False
+
+    for path in stage['outputs']:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    log_filename = os.path.join(state_dir, f'{stage["name"]}.log')
+    print(f'Running {stage["name"]} (see {log_filename}) ...')
+    start = time.perf_counter()
+    with open(log_filename, 'w') as log:
+        process = subprocess.run([sys.executable] + stage['command'] + list(extra_args),
+                                 stdout=log, stderr=subprocess.STDOUT)
+    if process.returncode != 0:
+        remove_outputs(stage)
+        with lock:
+            state['stages'].pop(stage['name'], None)
+            write_state(state)
+        raise RuntimeError(f'{stage["name"]} failed with exit code {process.returncode}, '
+                           f'see {log_filename}')
+
+    outputs = {path: digests.path(path) for path in stage['outputs']}
+    with lock:
+        state['stages'][stage['name']] = {'key': key, 'outputs': outputs}
+        state['digests'] = digests.snapshot()
+        write_state(state)
+    print(f'{stage["name"]} done in {time.perf_counter() - start:.1f}s')
+    return True
+
+
+def run(names=None, n_jobs=1, force=False, extra_args=()):
+    '''Runs the stages with the given names (the default ones if None) and the
+    ones they depend on, as far as they aren't up to date, with up to `n_jobs`
+    of them at the same time. Returns the names of the stages that ran.
+
+    `force` runs the given stages (but not the ones they depend on) even if
+    they're up to date, and `extra_args` are added to the command of every
+    stage.
+    '''
+    if names is None:
+        names = [stage['name'] for stage in stages if stage['default']]
+    todo = needed_stages(names, stages)
+    os.makedirs(state_dir, exist_ok=True)
+    with open(os.path.join(state_dir, 'lock'), 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        return run_stages(todo, names, n_jobs, force, extra_args)
+
+
+def run_stages(todo, names, n_jobs, force, extra_args):
+    '''Does the work of `run` for the given stages, once it's the only run.'''
+    from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+    state = read_state()
+    digests = Digests(state['digests'])
+    lock = threading.Lock()
+
+    ran, failed = [], []
+    with ThreadPoolExecutor(n_jobs) as pool:
+        running = {}
+        while todo or running:
+            # Start every stage whose dependencies are done (unless one failed,
+            # in which case we only wait for the ones that are still running).
+            ready = [stage for stage in todo
+                     if not dependencies(stage, todo + list(running.values()))]
+            for stage in ready if not failed else []:
+                todo.remove(stage)
+                running[pool.submit(run_stage, stage, state, digests, lock,
+                                    force=force and stage['name'] in names,
+                                    extra_args=extra_args)] = stage
+            if not running:
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage = running.pop(future)
+                try:
+                    if future.result():
+                        ran.append(stage['name'])
+                except Exception as e:
+                    print(e, file=sys.stderr)
+                    failed.append(stage['name'])
+
+    if failed:
+        raise RuntimeError(f'Failed stages: {", ".join(failed)}')
+    return ran
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Runs the stages of the data processing that changed since they last ran.')
+    parser.add_argument('stages', nargs='*',
+                        help='Stages to run (along with the ones they depend on), out of '
+                             + ', '.join(stage['name'] for stage in stages) +
+                             '. Defaults to ' +
+                             ', '.join(stage['name'] for stage in stages if stage['default']) + '.')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='Number of stages to run at the same time.')
+    parser.add_argument('--force', action='store_true',
+                        help='Run the given stages even if they\'re up to date.')
+    parser.add_argument('--stage_log', type=str, default=None,
+                        help='File to append the json records of the steps of all stages to '
+                             '(see instrumentation.py).')
+    args = vars(parser.parse_args())
+
+    os.chdir(root_dir)
+    try:
+        run(args['stages'] or None,
+            n_jobs=args['jobs'],
+            force=args['force'],
+            extra_args=['--stage_log', args['stage_log']] if args['stage_log'] else [])
+    except (RuntimeError, FileNotFoundError, ValueError) as e:
+        sys.exit(e)
@@ -0,0 +1,125 @@
+import os
+
+import numpy as np
+import pandas as pd
+import torch
+from fastai.basic_train import load_learner
+from fastai.core import listify
+from fastai.tabular import TabularList
+
+from feature_matrix import load_feature_frame, load_feature_matrix, target_column
+from instrumentation import add_instrumentation_arguments, configure_from_args, instrumented, stage
+from model_features import category_names, continuous_names
+from storage import write_frames
+
+
+# Scores the cards with a trained model in chunks, instead of getting the
+# predictions for the whole test set at once like the notebook does, so that
+# the memory needed doesn't grow with the number of cards.
+#
+# The model is a learner exported with `learn.export()` (see
+# `elo_loyalty_prediction.ipynb`), which also contains the state of the
+# preprocessors (FillMissing, Categorify, Normalize) fitted on the training
+# set. Every chunk is preprocessed with that state.
+
+
+def feature_chunks(filename, chunksize):
+    '''Yields the features of the cards in the given csv written by
+    `feature_engineering.py`, or in the directory of its feature matrix (see
+    `feature_matrix.py`), in data frames of `chunksize` cards each.'''
+    if os.path.isdir(filename):
+        rows = load_feature_matrix(filename)['meta']['rows']
+        for start in range(0, rows, chunksize):
+            yield load_feature_frame(filename, slice(start, start + chunksize))
+    else:
+        yield from pd.read_csv(filename, index_col='card_id', chunksize=chunksize)
+
+
+def missing_value_fills(learn):
+    '''Returns a map of the continuous features of the given learner that had no
+    missing values in the training set to the values to fill in for them.
+
+    The learner's `FillMissing` only fills the columns that had missing values
+    in the training set (those in its `na_dict`), and refuses to preprocess data
+    with missing values in any of the others. The notebook fills those in the
+    test set with the mean of the test cards, which would differ from chunk to
+    chunk here, so we take the mean of the training cards that the learner's
+    `Normalize` keeps instead.'''
+    procs = {type(proc).__name__: proc
+             for processor in listify(learn.data.train_ds.x.processor)
+             for proc in processor.procs}
+    na_dict = procs['FillMissing'].na_dict
+    return {col: mean for col, mean in procs['Normalize'].means.items() if col not in na_dict}
+
+
+def predict_chunk(learn, df, batch_size, fills=None):
+    '''Returns the predictions of the given learner for the cards in the given
+    data frame as an array, running the model on `batch_size` cards at a
+    time. Only the features of the model (see `model_features.py`) are used,
+    with the missing values in the columns of `fills` filled in (see
+    `missing_value_fills`).'''
+    df = df[category_names + continuous_names].fillna(fills or {})
+    learn.data.add_test(TabularList.from_df(df,
+                                            cat_names=category_names,
+                                            cont_names=continuous_names))
+    x = learn.data.test_ds.x
+    x_cat, x_cont = torch.from_numpy(x.codes), torch.from_numpy(x.conts)
+
+    predictions = []
+    with torch.no_grad():
+        for start in range(0, len(df), batch_size):
+            end = start + batch_size
+            predictions.append(learn.model(x_cat[start:end], x_cont[start:end]).view(-1).numpy())
+    return np.concatenate(predictions) if predictions else np.empty(0, dtype=np.float32)
+
+
+@instrumented()
+def write_predictions(learn, features_file, outfile, chunksize=100000, batch_size=8192):
+    '''Writes the predictions of the given learner for the cards in
+    `features_file` (see `feature_chunks`) to `outfile`, one chunk of
+    `chunksize` cards at a time. An outfile ending in '.zip' is written as a
+    zipped csv, like the submission of the notebook.'''
+    fills = missing_value_fills(learn)
+
+    def predictions():
+        for df in feature_chunks(features_file, chunksize):
+            with stage('predict_chunk', df) as record:
+                result = pd.DataFrame({target_column: predict_chunk(learn, df, batch_size, fills)},
+                                      index=df.index)
+                record['output'] = result
+            yield result
+
+    write_frames(predictions(), outfile)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Predicts the loyalty of cards with a trained model, in chunks of cards.')
+    parser.add_argument('model', type=str,
+                        help='Learner exported with learn.export(), e.g. learner/export.pkl.')
+    parser.add_argument('features', type=str,
+                        help='Features of the cards to score, either the csv written by '
+                             'feature_engineering.py or the directory of its feature matrix '
+                             '(see --matrix_dir).')
+    parser.add_argument('outfile', type=str, nargs='?', default='submission.csv.zip',
+                        help='File to write the predictions to. Written as a zipped csv if it ends '
+                             'in .zip. Defaults to submission.csv.zip.')
+    parser.add_argument('--chunksize', type=int, default=100000,
+                        help='Number of cards to read and preprocess at a time.')
+    parser.add_argument('--batch_size', type=int, default=8192,
+                        help='Number of cards to run the model on at a time.')
+    parser.add_argument('--threads', type=int, default=None,
+                        help='Number of threads for torch. Defaults to the number of CPUs.')
+    add_instrumentation_arguments(parser)
+    args = vars(parser.parse_args())
+    configure_from_args(args)
+
+    torch.set_num_threads(args['threads'] or os.cpu_count() or 1)
+    learn = load_learner(os.path.dirname(args['model']) or '.', os.path.basename(args['model']))
+    learn.model.eval()
+
+    write_predictions(learn, args['features'], args['outfile'],
+                      chunksize=args['chunksize'],
+                      batch_size=args['batch_size'])
@@ -0,0 +1,183 @@
+import json
+import os
+
+import pandas as pd
+from pandas.api.types import CategoricalDtype
+
+from instrumentation import instrumented
+
+
+# Intermediate files in `data/processed` are stored in a typed columnar format
+# (Parquet or Feather, via pyarrow), which keeps the dtypes of all columns,
+# including the categories of categorical columns and whether they're ordered,
+# so we don't have to re-parse dates and re-apply categorical types every time a
+# later stage loads them. CSV is only used for the raw data and final outputs.
+columnar_formats = ['.parquet', '.feather']
+
+
+def file_format(filename):
+    '''Returns the format of the given file based on its extension, i.e. one of
+    `columnar_formats` or '.csv'.'''
+    ext = os.path.splitext(filename)[1].lower()
+    return ext if ext in columnar_formats else '.csv'
+
+
+# The key of the metadata in which Feather files note which of their columns
+# are the index (see `feather_table`).
+feather_index_key = b'index'
+
+
+def feather_table(df, schema=None):
+    '''Feather can only store a default index, so we turn any other index of the
+    given data frame into columns, and note which columns they are (and the
+    names of the index levels) in the metadata of the returned pyarrow table, so
+    that `read_feather` can turn them back into the index.'''
+    import pyarrow as pa
+
+    if isinstance(df.index, pd.RangeIndex) and df.index.name is None:
+        return pa.Table.from_pandas(df.reset_index(drop=True), schema=schema,
+                                    preserve_index=False)
+    flat_df = df.reset_index()
+    index = {'columns': list(flat_df.columns[:df.index.nlevels]),
+             'names': list(df.index.names)}
+    table = pa.Table.from_pandas(flat_df, schema=schema, preserve_index=False)
+    return table.replace_schema_metadata({**(table.schema.metadata or {}),
+                                          feather_index_key: json.dumps(index)})
+
+
+def read_feather(filename, columns=None):
+    '''Reads a data frame written by `write_frame` or `write_frames` from the
+    given Feather file, with its index restored (see `feather_table`).'''
+    import pyarrow as pa
+    import pyarrow.feather as feather
+
+    with pa.memory_map(filename) as source:
+        metadata = pa.ipc.open_file(source).schema.metadata or {}
+    index = json.loads(metadata.get(feather_index_key, 'null'))
+    if index is None:
+        return feather.read_table(filename, columns=columns).to_pandas()
+    if columns is not None:
+        columns = index['columns'] + [c for c in columns if c not in index['columns']]
+    df = feather.read_table(filename, columns=columns).to_pandas().set_index(index['columns'])
+    df.index.names = index['names']
+    return df
+
+
+@instrumented()
+def write_frame(df, filename):
+    '''Writes the given data frame to the given file, in the format implied by
+    the extension of the filename (see `file_format`). The index is written
+    along with the data in all formats.
+    '''
+    fmt = file_format(filename)
+    if fmt == '.parquet':
+        df.to_parquet(filename, engine='pyarrow')
+    elif fmt == '.feather':
+        import pyarrow.feather as feather
+        feather.write_feather(feather_table(df), filename)
+    else:
+        df.to_csv(filename)
+
+
+def write_frames(frames, filename):
+    '''Writes the given data frames (any iterable, e.g. a generator) one after
+    the other to the given file, as if they were a single data frame, so only one
+    of them has to be in memory at any time. They all need to have the same
+    columns and dtypes (including the categories of categorical columns).
+
+    A csv filename ending in '.zip' is written compressed (see
+    `write_zipped_csv`).
+    '''
+    fmt = file_format(filename)
+    if fmt == '.csv' and filename.lower().endswith('.zip'):
+        write_zipped_csv(frames, filename)
+        return
+    if fmt == '.csv':
+        for i, df in enumerate(frames):
+            df.to_csv(filename, mode='w' if i == 0 else 'a', header=i == 0)
+        return
+
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    writer, schema = None, None
+    try:
+        for df in frames:
+            if fmt == '.feather':
+                table = feather_table(df, schema=schema)
+            else:
+                table = pa.Table.from_pandas(df, schema=schema,
+                                             preserve_index=True)
+            if writer is None:
+                schema = table.schema
+                if fmt == '.parquet':
+                    writer = pq.ParquetWriter(filename, schema)
+                else:
+                    writer = pa.ipc.new_file(filename, schema)
+            writer.write_table(table)
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+def write_zipped_csv(frames, filename):
+    '''Writes the given data frames one after the other as a csv into a zip
+    archive with the given name, like `to_csv(filename, compression='zip')` does
+    with a single data frame: the csv in the archive is named like the archive
+    without the '.zip', e.g. 'submission.csv' in 'submission.csv.zip'.
+
+    The csv is compressed as it's written, so neither the data frames nor the
+    csv need to be in memory as a whole.
+    '''
+    import io
+    import zipfile
+
+    member = os.path.basename(filename)[:-len('.zip')]
+    with zipfile.ZipFile(filename, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        with io.TextIOWrapper(archive.open(member, 'w', force_zip64=True),
+                              encoding='utf-8', newline='') as f:
+            for i, df in enumerate(frames):
+                df.to_csv(f, header=i == 0)
+
+
+def read_frame(filename, columns=None, **csv_kwargs):
+    '''Reads a data frame from the given file, in the format implied by the
+    extension of the filename (see `file_format`).
+
+    Columnar formats come back with the dtypes they were written with, the
+    `csv_kwargs` are only passed on to `pd.read_csv` for CSV files. If
+    `columns` is given, only those columns are read.
+    '''
+    fmt = file_format(filename)
+    if fmt == '.parquet':
+        df = pd.read_parquet(filename, engine='pyarrow', columns=columns)
+        restore_parquet_categoricals(df, filename)
+        return df
+    elif fmt == '.feather':
+        return read_feather(filename, columns=columns)
+    else:
+        return pd.read_csv(filename, usecols=columns, **csv_kwargs)
+
+
+def restore_parquet_categoricals(df, filename):
+    '''Parquet only keeps categorical columns with string categories as such,
+    ones with numerical categories (e.g. `city_id` or `category_2`) come back as
+    plain numbers. The pandas metadata in the file still knows they were
+    categorical, though, so we use that to turn them back into (ordered, if they
+    were) categories.
+
+    The given data frame is mutated in place.
+    '''
+    import pyarrow.parquet as pq
+
+    metadata = pq.read_schema(filename).pandas_metadata or {}
+    for col in metadata.get('columns', []):
+        name = col['name']
+        if col['pandas_type'] != 'categorical' or name not in df.columns:
+            continue
+        ordered = col['metadata']['ordered']
+        if df[name].dtype == 'category':
+            if df[name].cat.ordered != ordered:
+                df[name] = df[name].cat.set_ordered(ordered)
+        else:
+            df[name] = df[name].astype(CategoricalDtype(ordered=ordered))